@@ -0,0 +1,212 @@
+import ast
+import keyword
+import linecache
+import struct
+import types
+import records
+
+GENERATEDNAMES = { 'int', 'len', 'list', 'range' }
+
+class RecordCompiler:
+    ''' Translates a plain record definition into a single specialised read function '''
+    def __init__(self, reader, functions):
+        self.reader = reader
+        self.functions = functions
+        self.objects = {}
+        self.lines = []
+
+    def bind(self, obj):
+        ''' Makes an object available to the generated code under a private name '''
+        for name, bound in self.objects.items():
+            if bound is obj:
+                return name
+        name = '_o{0}'.format(len(self.objects))
+        self.objects[name] = obj
+        return name
+
+    def emit(self, line):
+        self.lines.append('        ' + line)
+
+    def expression(self, expr, known):
+        ''' Checks that an expression can be inlined, i.e. it refers only to fields already read '''
+        tree = ast.parse(expr.source, mode='eval')
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name) and node.id in self.fieldnames and node.id not in known:
+                return None
+        return '(' + expr.source + ')'
+
+    def compilable(self):
+        self.fieldnames = set( map(lambda f: f.name, self.reader.fields) )
+        for name in self.fieldnames:
+            if not name.isidentifier() or keyword.iskeyword(name) or name.startswith('_') or name in self.functions:
+                return False
+            if name in GENERATEDNAMES:
+                return False
+        return True
+
+    def generate(self):
+        if not self.compilable():
+            return None
+        known = set()
+        if self.reader.selector is not None:
+            self.emit('_pos = _datafile.getpos()')
+        self.emit('_data = _PlainRecord(_meta)')
+        run = []
+        lazy = []
+        for field in self.reader.fields:
+            if field.name in self.reader.lazyfields:
+                self.generaterun(run, known)
+                run = []
+                if not self.generatelazy(field, known, lazy):
+                    return None
+                continue
+            if self.getformat(field) is not None:
+                run.append(field)
+                continue
+            self.generaterun(run, known)
+            run = []
+            if not self.generatefield(field, known):
+                return None
+            known.add(field.name)
+        self.generaterun(run, known)
+        if len(self.reader.lazyfields) > 0:
+            self.emit('_data._lazy = (_datafile, ({0}))'.format(''.join( map(lambda x: x + ', ', lazy) )))
+        for t in self.reader.transforms:
+            context = ', '.join( map(lambda x: "'{0}': {0}".format(x), dict.fromkeys(f.name for f in self.reader.fields)) )
+            self.emit('{0}.transform({{{1}}})'.format(self.bind(t), context))
+        if self.reader.selector is not None:
+            self.emit('return {0}.select(_datafile, _pos, _data)'.format(self.bind(self.reader.selector)))
+        else:
+            self.emit('return _data')
+        head = [ 'def _make(_meta, _PlainRecord{0}):'.format(''.join(map(lambda x: ', ' + x, self.objects))),
+                 '    def read(_datafile):' ]
+        return '\n'.join(head + self.lines + ['    return read', ''])
+
+    def generatefield(self, field, known):
+        name = field.name
+        reader = field.reader
+        if isinstance(reader, records.FunctionReader):
+            value = self.expression(reader.func, known)
+            if value is None:
+                return False
+        elif field.count is not None:
+            count = self.expression(field.count, known)
+            if count is None:
+                return False
+            value = '[{0} for _i in range({1})]'.format(self.readexpr(reader.simple), count)
+        elif type(reader) is records.FreeReader:
+            self.emit('_datafile.seek({0}, 1)'.format(reader.count))
+            value = 'None'
+        else:
+            value = self.readexpr(reader)
+        self.emit('{0} = {1}'.format(name, value))
+        if field.localref is not None:
+            for pname, xref in field.localref.params.items():
+                pvalue = self.expression(xref, known)
+                if pvalue is None:
+                    return False
+                self.emit('{0}.{1} = {2}'.format(name, pname, pvalue))
+            if field.globalref is None:
+                self.emit('{0}.reset()'.format(name))
+        if field.globalref is not None:
+            self.emit('{0}.addinstance({1})'.format(self.bind(field.globalref), name))
+        self.emit('_data.{0} = {0}'.format(name))
+        return True
+
+    def generatelazy(self, field, known, lazy):
+        ''' Records the position of a lazy field and moves past its value '''
+        if isinstance(field.reader, records.FunctionReader):
+            lazy.append('None')
+            return True
+        offset = '_lz{0}'.format(len(lazy))
+        lazy.append(offset)
+        self.emit('{0} = _datafile.getpos()'.format(offset))
+        if field.count is not None:
+            count = self.expression(field.count, known)
+            if count is None:
+                return False
+            self.emit('_datafile.seek({0} * {1}, 1)'.format(count, field.reader.simple.getsize()))
+        else:
+            self.emit('{0}.skip(_datafile)'.format(self.bind(field.reader)))
+        return True
+
+    def getformat(self, field):
+        ''' Returns the struct format of a field that has a static layout '''
+        if field.count is not None or field.localref is not None or field.globalref is not None:
+            return None
+        if isinstance(field.reader, records.PlainRecordReader) or not hasattr(field.reader, 'getformat'):
+            return None
+        return field.reader.getformat()
+
+    def generaterun(self, run, known):
+        ''' Decodes a run of fixed-width fields with a single read and a single unpack '''
+        known.update( map(lambda f: f.name, run) )
+        if len(run) == 0:
+            return
+        if len(run) == 1:
+            self.generatefield(run[0], known)
+            return
+        layout = struct.Struct('<' + ''.join( map(self.getformat, run) ))
+        self.emit('_b = _datafile.read({0})'.format(layout.size))
+        self.emit('if len(_b) == {0} and _b.__class__ is not list:'.format(layout.size))
+        self.emit('    _v = {0}.unpack_from(_b)'.format(self.bind(layout)))
+        ivalue = 0
+        for field in run:
+            count = len(struct.Struct('<' + self.getformat(field)).unpack(bytes(field.reader.getsize())))
+            if type(field.reader) is records.ArrayReader:
+                self.emit('    {0} = list(_v[{1}:{2}])'.format(field.name, ivalue, ivalue+count))
+            elif count == 0:
+                self.emit('    {0} = None'.format(field.name))
+            else:
+                self.emit('    {0} = _v[{1}]'.format(field.name, ivalue))
+            ivalue += count
+        self.emit('else:')
+        offset = 0
+        for field in run:
+            self.emit('    {0} = {1}'.format(field.name, self.sliceexpr(field.reader, offset)))
+            offset += field.reader.getsize()
+        for field in run:
+            self.emit('_data.{0} = {0}'.format(field.name))
+
+    def sliceexpr(self, reader, offset):
+        ''' Returns an expression that decodes a value from a short or non-bytes buffer '''
+        end = offset + reader.getsize()
+        if type(reader) is records.IntReader:
+            return "int.from_bytes(_b[{0}:{1}], 'little')".format(offset, end)
+        if type(reader) is records.BytesReader:
+            return '_b[{0}:{1}]'.format(offset, end)
+        if type(reader) is records.ArrayReader:
+            size = reader.simple.getsize()
+            return "[int.from_bytes(_b[_i:_i+{0}], 'little') for _i in range({1}, {2}, {0})]".format(size, offset, end)
+        return 'None'
+
+    def readexpr(self, reader):
+        ''' Returns an expression that reads a single value with the given reader '''
+        if type(reader) is records.IntReader:
+            return "int.from_bytes(_datafile.read({0}), 'little')".format(reader.size)
+        if type(reader) is records.BytesReader:
+            return '_datafile.read({0})'.format(reader.count)
+        if type(reader) is records.ArrayReader:
+            return '[{0} for _i in range({1})]'.format(self.readexpr(reader.simple), reader.count)
+        return '{0}.read(_datafile)'.format(self.bind(reader))
+
+    def compile(self):
+        source = self.generate()
+        if source is None:
+            return None
+        filename = '<record {0}>'.format(self.reader.name)
+        linecache.cache[filename] = (len(source), None, source.splitlines(True), filename)
+        namespace = {}
+        exec(compile(source, filename, 'exec'), namespace)
+        read = namespace['_make'](self.reader, self.reader.recordclass, *self.objects.values())
+        self.reader.compiled = source
+        return types.FunctionType(read.__code__, self.functions, read.__name__, read.__defaults__, read.__closure__)
+
+def compilerecord(reader, functions):
+    return RecordCompiler(reader, functions).compile()
+
+def compilerecords(readers, functions):
+    for reader in readers:
+        read = compilerecord(reader, functions)
+        if read is not None:
+            reader.read = read
@@ -0,0 +1,45 @@
+import ast
+import builtins
+import types
+
+BUILTINS = { '__builtins__': builtins }
+
+class Expression:
+    ''' An expression of the structure language compiled once at load time '''
+    def __init__(self, source, where):
+        self.source = str(source).strip()
+        self.where = where
+        try:
+            self.code = compile(self.source, '<' + where + '>', 'eval')
+        except SyntaxError as e:
+            raise Exception(f'Bad expression "{self.source}" in {where}: {e.msg}') from None
+        self.nested = any( isinstance(c, types.CodeType) for c in self.code.co_consts )
+
+    def __repr__(self):
+        return self.source
+
+    def getnames(self):
+        ''' Returns the names the expression refers to '''
+        return set( node.id for node in ast.walk(ast.parse(self.source, mode='eval')) if isinstance(node, ast.Name) )
+
+    def evaluate(self, context, statctx=None):
+        ''' Evaluates the expression, the context is either a dictionary or a read-only mapping of names.
+            Comprehensions and lambdas see only globals, so for them the names are copied into a dictionary '''
+        if type(context) is dict:
+            return eval(self.code, context, statctx)
+        if self.nested:
+            namespace = dict(BUILTINS if statctx is None else statctx)
+            namespace.update(context)
+            return eval(self.code, namespace)
+        return eval(self.code, BUILTINS if statctx is None else statctx, context)
+
+def getcontext(obj):
+    ''' Returns the evaluation namespace of an object '''
+    if hasattr(obj, 'getview'):
+        return obj.getview()
+    if hasattr(obj, 'getfields'):
+        return obj.getfields()
+    return vars(obj)
+
+def load(source, where):
+    return Expression(source, where)
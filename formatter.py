@@ -1,5 +1,6 @@
 import yaml
 import records
+import expression
 
 class Formatter:
     def __init__(self):
@@ -36,12 +37,12 @@ class Formatter:
                 pyfile.loadformatters(self, yfmt['options'])
             if 'formatters' in yfmt:
                 for yobject, yformatter in yfmt['formatters'].items():
-                    self.overrides[yobject] = self.formatters[yformatter]
+                    self.overrides[expression.load(yobject, 'formatters of ' + filename)] = self.formatters[yformatter]
 
     def apply(self, data):
         context = data.getfields()
         for oref, formatter in self.overrides.items():
-            eval(oref, context)._meta.formatter = formatter
+            oref.evaluate(context)._meta.formatter = formatter
 
 class StreamFormatter:
     def __init__(self):
@@ -1,10 +1,20 @@
 import records
 import formatter
+import streams
 
-def load(structure, filename):
+def load(structure, filename, compiled=True, mapped=False, lazy=False, **params):
+    ''' Reads a file into the target of a structure, a target that holds the file to read from it later
+        closes it itself. Lazy records keep the file they decode from, it is closed when they are gone '''
     fmt = formatter.getminimal()
-    strdef = records.loadmeta(structure, fmt)
-    with open(filename, 'rb') as datafile:
-        obj = strdef.read(datafile)
-        return strdef.gettarget(obj)
-
+    strdef = records.loadmeta(structure, fmt, compiled, lazy)
+    datafile = open(filename, 'rb')
+    try:
+        if mapped:
+            datafile = streams.MappedFile(datafile)
+        target = strdef.gettarget(strdef.read(datafile, **params))
+    except:
+        datafile.close()
+        raise
+    if not lazy and getattr(target, 'datafile', None) is not datafile:
+        datafile.close()
+    return target
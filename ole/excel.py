@@ -1,13 +1,42 @@
 import os
+import sys
+import math
 import struct
+import array
+import bisect
+import itertools
+import csv
+import concurrent.futures
+import records
 import streams
 import parser
 import formatter
-from functools import cached_property
+
+EOF = 0x0A
+FORMULA = 0x06
+FORMULASTRING = 0x0207
+MULRK = 0x0BD
+CELLRECORDS = { 0x06: 'addformulacell', 0x0BD: 'addmulrkcell', 0x0FD: 'addsstcell', 0x0207: 'addformulastring',
+                0x027E: 'addrkcell' }
 
 class Workbook:
+    ''' The sheets of a workbook, a deferred workbook holds the file its sheets are read from
+        until it is closed '''
     def __init__(self):
         self.sheets = {}
+        self.loaders = {}
+        self.datafile = None
+
+    def close(self):
+        if self.datafile is not None:
+            self.datafile.close()
+            self.datafile = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
     def addsheet(self, name):
         self.sheets[name] = Sheet(name)
@@ -16,26 +45,252 @@ class Workbook:
     def getsheet(self, name):
         return self.sheets[name]
 
+    def iterrows(self, name):
+        ''' Yields the rows of a sheet while its records are read '''
+        return self.loaders[name].iterrows()
+
+    def iterblocks(self, name, rows=64):
+        ''' Yields the cells of a sheet in blocks of rows while its records are read '''
+        return self.loaders[name].iterblocks(rows)
+
 class Cell:
-    def __init__(self, value):
+    __slots__ = ('value', 'formula')
+
+    def __init__(self, value, formula=None):
         self.value = value
-        self.formula = None
+        self.formula = formula
+
+class SheetCell:
+    ''' Stands for a cell of a plain value or an empty cell, the sheet keeps only the value and
+        setting the value of this cell sets it in the sheet '''
+    __slots__ = ('sheet', 'row', 'column', '_value')
+    formula = None
+
+    def __init__(self, sheet, row, column, value):
+        self.sheet = sheet
+        self.row = row
+        self.column = column
+        self._value = value
+
+    @property
+    def value(self):
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        self._value = value
+        dense = self.sheet.dense
+        self.sheet.setvalue(self.row, self.column, value)
+        if dense is not None and dense[self.row].cells[self.column] is self:
+            self.sheet.dense = dense
 
 class Row:
     def __init__(self):
         self.cells = []
 
 class Sheet:
+    ''' Keeps only the cells that exist, keys are sorted row and column pairs packed into integers.
+        Values are kept as they are, a cell object is kept only for formulas '''
     def __init__(self, name):
         self.name = name
-        self.rows = []
+        self.keys = array.array('Q')
+        self.values = []
+        self.dense = None
+
+    def setvalue(self, row, column, value):
+        self.setitem(getkey(row, column), value)
+
+    def setformula(self, row, column, value, formula):
+        cell = Cell(value, formula)
+        self.setitem(getkey(row, column), cell)
+        return cell
+
+    def setvalues(self, row, column, values):
+        ''' Sets the values of adjacent cells of a row '''
+        key = getkey(row, column)
+        self.dense = None
+        if len(self.keys) == 0 or key > self.keys[-1]:
+            self.keys.extend( range(key, key + len(values)) )
+            self.values.extend(values)
+            return
+        for value in values:
+            self.setitem(key, value)
+            key += 1
+
+    def setitem(self, key, value):
+        self.dense = None
+        if len(self.keys) == 0 or key > self.keys[-1]:
+            self.keys.append(key)
+            self.values.append(value)
+            return
+        index = bisect.bisect_left(self.keys, key)
+        if index < len(self.keys) and self.keys[index] == key:
+            self.values[index] = value
+        else:
+            self.keys.insert(index, key)
+            self.values.insert(index, value)
 
     def getcell(self, row, column):
-        if not (0 <= row and row < len(self.rows)):
-            return None
-        if not (0 <= column and column < len(self.rows[row].cells)):
+        ''' Returns a cell, an empty cell before the last cell of a row or None past it.
+            Setting the value of the cell sets it in the sheet '''
+        if row < 0 or not (0 <= column <= 0xFFFF):
             return None
-        return self.rows[row].cells[column]
+        key = getkey(row, column)
+        index = bisect.bisect_left(self.keys, key)
+        if index < len(self.keys) and self.keys[index] == key:
+            return self.makecell(row, column, self.values[index])
+        if column < self.getwidth(row):
+            return SheetCell(self, row, column, None)
+        return None
+
+    def getwidth(self, row):
+        ''' Returns the number of columns of a row up to its last cell '''
+        index = bisect.bisect_left(self.keys, getkey(row+1, 0))
+        if index == 0 or self.keys[index-1] >> 16 != row:
+            return 0
+        return (self.keys[index-1] & 0xFFFF) + 1
+
+    def getheight(self):
+        ''' Returns the number of rows up to the last cell '''
+        return (self.keys[-1] >> 16) + 1 if len(self.keys) > 0 else 0
+
+    def itercells(self):
+        ''' Yields the row, the column and the cell of every existing cell in row order,
+            setting the value of a cell sets it in the sheet '''
+        for key, value in zip(self.keys, self.values):
+            yield key >> 16, key & 0xFFFF, self.makecell(key >> 16, key & 0xFFFF, value)
+
+    def makecell(self, row, column, value):
+        return value if value.__class__ is Cell else SheetCell(self, row, column, value)
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def rows(self):
+        ''' Dense rows of cells, a view built once after the sheet changes. Setting the value of a cell
+            sets it in the sheet, empty cells are not kept in the sheet until they are set '''
+        if self.dense is not None:
+            return self.dense
+        rows = [ Row() for i in range(self.getheight()) ]
+        for row, column, cell in self.itercells():
+            cells = rows[row].cells
+            while len(cells) < column:
+                cells.append( SheetCell(self, row, len(cells), None) )
+            cells.append(cell)
+        self.dense = rows
+        return rows
+
+def getkey(row, column):
+    return (row << 16) | column
+
+CHUNKSIZE = 4096
+NUMERIC = { int, float }
+
+def iterchunks(source, chunksize=CHUNKSIZE, rows=None, columns=None):
+    ''' Yields the first row and the rows of values of consecutive chunks of rows.
+        The source is a sheet or blocks of a sheet as iterblocks yields them, rows and columns are
+        (start, stop) ranges, a chunk of blocks without columns is as wide as its widest row '''
+    rowstart, rowstop = rows if rows is not None else (0, None)
+    if isinstance(source, Sheet):
+        if rowstop is None:
+            rowstop = source.getheight()
+        if columns is None:
+            columns = (0, max( map(lambda key: key & 0xFFFF, source.keys) ) + 1 if len(source) > 0 else 0)
+        source = [ source ]
+    nextrow = rowstart
+    for block in source:
+        stop = block.getheight() if rowstop is None else min(block.getheight(), rowstop)
+        for start in range(nextrow, stop, chunksize):
+            chunk = makechunk(block, start, min(start + chunksize, stop), columns)
+            yield start, chunk
+        nextrow = max(nextrow, stop)
+    if rowstop is not None and nextrow < rowstop:
+        for start in range(nextrow, rowstop, chunksize):
+            chunk = makechunk(Sheet(None), start, min(start + chunksize, rowstop), columns)
+            yield start, chunk
+
+def makechunk(sheet, start, stop, columns):
+    ''' Returns the values of the rows from start to stop as lists of equal length, empty cells are None '''
+    first = bisect.bisect_left(sheet.keys, getkey(start, 0))
+    last = bisect.bisect_left(sheet.keys, getkey(stop, 0))
+    if columns is None:
+        colstart = 0
+        ncols = max( map(lambda key: key & 0xFFFF, sheet.keys[first:last]) ) + 1 if last > first else 0
+    else:
+        colstart = columns[0]
+        ncols = columns[1] - columns[0]
+    chunk = [ [None] * ncols for i in range(stop - start) ]
+    for key, value in zip(sheet.keys[first:last], sheet.values[first:last]):
+        column = (key & 0xFFFF) - colstart
+        if 0 <= column < ncols:
+            chunk[(key >> 16) - start][column] = value.value if value.__class__ is Cell else value
+    return chunk
+
+def getcolumntypes(chunk):
+    ''' Infers the type of every column of a chunk: empty, int, float or string '''
+    types = []
+    for column in zip(*chunk):
+        kinds = set( map(type, column) )
+        kinds.discard(type(None))
+        if len(kinds) == 0:
+            types.append('empty')
+        elif kinds == { int }:
+            types.append('int')
+        elif kinds <= NUMERIC:
+            types.append('float')
+        else:
+            types.append('string')
+    return types
+
+def exportcsv(source, filename, chunksize=CHUNKSIZE, rows=None, columns=None):
+    ''' Writes a sheet or blocks of a sheet to a CSV file a chunk at a time, returns the number of rows '''
+    count = 0
+    with open(filename, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        for start, chunk in iterchunks(source, chunksize, rows, columns):
+            writer.writerows(chunk)
+            count += len(chunk)
+    return count
+
+def exportnpy(source, filename, chunksize=CHUNKSIZE, rows=None, columns=None, nanstrings=False):
+    ''' Writes a sheet or blocks of a sheet to an NPY file of doubles a chunk at a time. Integers are
+        written as doubles and empty cells as NaN, a column holding strings is an error unless nanstrings
+        is set, then strings become NaN too. The header is rewritten with the number of rows at the end '''
+    if columns is None and not isinstance(source, Sheet):
+        raise Exception('Columns are required to export blocks of a sheet to NPY')
+    count = 0
+    ncols = None
+    with open(filename, 'wb') as npyfile:
+        npyfile.write(getnpyheader(0, 0))
+        for start, chunk in iterchunks(source, chunksize, rows, columns):
+            ncols = len(chunk[0]) if ncols is None else ncols
+            types = getcolumntypes(chunk) if not nanstrings else []
+            if 'string' in types:
+                icol = types.index('string')
+                raise Exception(f'Column {icol + (columns[0] if columns else 0)} holds strings at rows from {start}, NPY takes numbers only')
+            data = array.array('d', map(getdoublevalue, itertools.chain.from_iterable(chunk)))
+            if sys.byteorder != 'little':
+                data.byteswap()
+            data.tofile(npyfile)
+            count += len(chunk)
+        npyfile.seek(0)
+        npyfile.write(getnpyheader(count, ncols or 0))
+    return count
+
+NPYHEADERSIZE = 128
+
+def getnpyheader(nrows, ncols):
+    ''' Returns an NPY version 1.0 header of a fixed size so that it can be rewritten in place '''
+    header = "{{'descr': '<f8', 'fortran_order': False, 'shape': ({0}, {1}), }}".format(nrows, ncols)
+    header = header.ljust(NPYHEADERSIZE - 11) + '\n'
+    return b'\x93NUMPY\x01\x00' + len(header).to_bytes(2, 'little') + header.encode('latin-1')
+
+def getdoublevalue(value):
+    ''' Returns a number as it is and NaN for empty cells and strings '''
+    if value.__class__ is float or value.__class__ is int:
+        return value
+    return math.nan
 
 class SheetLoader:
     def __init__(self, wbloader, sheet, offset):
@@ -43,50 +298,125 @@ class SheetLoader:
         self.sheet = sheet
         self.wbrawstream = wbloader.rawstream
         self.bookoffset = offset
+        self.lastformula = None
 
-    def addcell(self, biff8):
-        while len(self.sheet.rows) <= biff8.record.row:
-            self.sheet.rows.append(Row())
-        row = self.sheet.rows[biff8.record.row]
-        while len(row.cells) <= biff8.record.column:
-            row.cells.append( Cell(None) )
-        return row.cells[biff8.record.column]
+    def load(self, op=None):
+        ''' Reads the cells of the sheet, a deferred workbook reads them only when they are iterated '''
+        if self.wbloader.deferred:
+            return
+        for biff8 in self.readrecords():
+            if biff8.rectype in CELLRECORDS and self.selects(biff8):
+                getattr(self, CELLRECORDS[biff8.rectype])(biff8)
+
+    def selects(self, biff8):
+        ''' Tells whether a cell record is inside the selected rows and columns, only the row and the columns
+            at the start and at the end of the raw record are read '''
+        wbloader = self.wbloader
+        if wbloader.rows is None and wbloader.columns is None:
+            return True
+        if biff8.rectype == FORMULASTRING:
+            return self.lastformula is not None
+        raw = biff8.buffer
+        start = biff8.offset
+        end = min(start + biff8.size, len(raw))
+        if end - start < 4:
+            return True
+        selected = True
+        if wbloader.rows is not None:
+            row = raw[start] | (raw[start+1] << 8)
+            selected = wbloader.rows[0] <= row < wbloader.rows[1]
+        if selected and wbloader.columns is not None:
+            first = raw[start+2] | (raw[start+3] << 8)
+            last = raw[end-2] | (raw[end-1] << 8) if biff8.rectype == MULRK else first
+            selected = first < wbloader.columns[1] and last >= wbloader.columns[0]
+        if not selected and biff8.rectype == FORMULA:
+            self.lastformula = None
+        return selected
+
+    def readrecords(self):
+        ''' Yields the records of the sheet up to its end of file record '''
+        self.bookstream.seek(0)
+        while True:
+            items = self.bookstream.read(1)
+            if len(items) == 0 or items[0].rectype == EOF:
+                return
+            yield items[0]
+
+    def iterblocks(self, rows=64):
+        ''' Yields sheets that hold the cells of up to the given number of rows, cells are added to a block
+            instead of the sheet so that only one block is kept '''
+        sheet = self.sheet
+        self.sheet = Sheet(sheet.name)
+        try:
+            limit = None
+            for biff8 in self.readrecords():
+                if biff8.rectype not in CELLRECORDS or not self.selects(biff8):
+                    continue
+                if hasattr(biff8.record, 'row'):
+                    row = biff8.record.row
+                    if limit is not None and row >= limit and len(self.sheet) > 0:
+                        yield self.sheet
+                        self.sheet = Sheet(sheet.name)
+                    if limit is None or row >= limit:
+                        limit = row - row % rows + rows
+                getattr(self, CELLRECORDS[biff8.rectype])(biff8)
+            if len(self.sheet) > 0:
+                yield self.sheet
+        finally:
+            self.sheet = sheet
+
+    def iterrows(self):
+        ''' Yields the index and the row of every row that has cells '''
+        for block in self.iterblocks(1):
+            row = Row()
+            for irow, column, cell in block.itercells():
+                while len(row.cells) < column:
+                    row.cells.append( SheetCell(block, irow, len(row.cells), None) )
+                row.cells.append(cell)
+            yield irow, row
 
     def addrkcell(self, biff8):
-        self.addcell(biff8).value = self.readrknum(biff8.record.rknum)
+        self.sheet.setvalue(biff8.record.row, biff8.record.column, self.readrknum(biff8.record.rknum))
 
     def addmulrkcell(self, biff8):
-        lastcol = int.from_bytes( bytes(biff8.record.rawvalue[-2:]) , 'little')
-        ipos = 2
-        if (lastcol-biff8.record.column+1)*6 != len(biff8.record.rawvalue)-2:
+        rawvalue = biff8.record.rawvalue
+        rawvalue.seek(0)
+        raw = rawvalue.read(len(rawvalue))
+        lastcol = int.from_bytes( bytes(raw[-2:]) , 'little')
+        if (lastcol-biff8.record.column+1)*6 != len(raw)-2:
             raise Exception(f'Bad mulrk record')
-        while biff8.record.column <= lastcol:
-            self.addcell(biff8).value = self.readrknum( int.from_bytes( bytes(biff8.record.rawvalue[ipos:ipos+4]) , 'little') )
-            biff8.record.column += 1
-            ipos += 6
+        values = readrknums(raw[:-2])
+        column = biff8.record.column
+        columns = self.wbloader.columns
+        if columns is not None:
+            first = max(column, columns[0])
+            values = values[first-column:columns[1]-column]
+            column = first
+        self.sheet.setvalues(biff8.record.row, column, values)
 
     def addformulacell(self, biff8):
-        cell = self.addcell(biff8)
+        pending = False
         if biff8.record.value[6] == 0xFF and biff8.record.value[7] == 0xFF:
             if biff8.record.value[0] == 0 or biff8.record.value[0] == 2:
                 value = None
-                self.lastformula = cell
+                pending = True
             else:
                 raise Exception(f'Unknown formula value type {biff8.record.value[0]} at row {biff8.record.row} column {biff8.record.column}')
         else:
             value = getdouble(biff8.record.value)
-        cell.value = value
 #        print(biff8.record.rawformulastream)
 #        if (biff8.record.status & 0x08) == 0x08:
 #            raise Exception("Can't yet parse shared formulas")
-        cell.formula = biff8.record.formulastream.readall()
+        cell = self.sheet.setformula(biff8.record.row, biff8.record.column, value, biff8.record.formulastream.readall())
+        if pending:
+            self.lastformula = cell
 
     def addformulastring(self, biff8):
         self.lastformula.value = biff8.record.value
         self.lastformula = None
 
     def addsstcell(self, biff8):
-        self.addcell(biff8).value = self.wbloader.stringtable[biff8.record.isst]
+        self.sheet.setvalue(biff8.record.row, biff8.record.column, self.wbloader.stringtable[biff8.record.isst])
 
     def readrknum(self, rknum):
         if (rknum & 0x02) == 0x02:
@@ -99,95 +429,264 @@ class SheetLoader:
         return value
 
 class WorkbookLoader:
-    def __init__(self, rawstream):
+    ''' Builds a workbook, only the selected sheets are loaded and only the cells inside the selected
+        (start, stop) ranges of rows and columns are added. With string indexes the SST is not parsed
+        and cells keep indexes into it, without cached strings every string is decoded when it is used '''
+    def __init__(self, rawstream, deferred=False, sheets=None, rows=None, columns=None, stringindexes=False,
+                 cachedstrings=True):
         self.rawstream = rawstream
+        self.deferred = deferred
+        self.stringindexes = stringindexes
+        self.cachedstrings = cachedstrings
+        self.selected = [ sheets ] if isinstance(sheets, str) else sheets
+        self.rows = tuple(rows) if rows is not None else None
+        self.columns = tuple(columns) if columns is not None else None
         self.target = Workbook()
+        if deferred:
+            self.target.datafile = rawstream.datafile
         self.sheets = []
-        self.stringtable = []
+        self.stringtable = SharedStrings() if stringindexes else []
 
     def collector(self, first):
         return parser.collector(first)
 
     def setstringtable(self, recs):
-        irecord = 0
-        data = recs[0].record.rawstrings
-        while True:
-            charnum = int.from_bytes(data.read(2), 'little')
-            strmod = int.from_bytes(data.read(1), 'little')
-            if (strmod & 0x0F6) != 0:
-                ipos = data.getpos()-3
-                raise Exception(f'Not yet implemented modifier {strmod:X} at {irecord:X}/{ipos:X}')
-            if (strmod & 0x1) == 1:
-                method = 'utf-16'
-                size = 2*charnum
-            else:
-                method = 'ascii'
-                size = charnum
-            if (strmod & 0x08) == 0x08:
-                formatsize = int.from_bytes(data.read(2), 'little') * 4
-            else:
-                formatsize = 0
-            string = ''
-            if data.getpos()+size > len(data):
-                size = len(data)-data.getpos()
-                string += data.read(size).decode(method)
-                charnum -= size//2 if method == 'utf-16' else size
-                irecord += 1
-                data = recs[irecord].record.rawdata
-                data.seek(0)
-                strmod = int.from_bytes(data.read(1), 'little')
-                if (strmod & 0x1) == 1:
-                    method = 'utf-16'
-                    size = 2*charnum
-                else:
-                    method = 'ascii'
-                    size = charnum
-            string += data.read(size).decode(method)
-            self.stringtable.append(string)
-            if data.getpos()+formatsize > len(data):
-                formatsize -= len(data)-data.getpos()
-                data.seek(len(data)-data.getpos(), os.SEEK_CUR)
-            else:
-                data.seek(formatsize, os.SEEK_CUR)
-                formatsize = 0
-            if data.getpos() >= len(data):
-                irecord += 1
-                if irecord >= len(recs):
-                    break
-                data = recs[irecord].record.rawdata
-                data.seek(0)
-            data.seek(formatsize, os.SEEK_CUR)
+        if self.stringindexes:
+            self.stringtable = SharedStrings()
+            return
+        segments = [ recs[0].record.rawstrings ] + [ r.record.rawdata for r in recs[1:] ]
+        self.stringtable = StringTable(segments, self.cachedstrings)
 
     def addsheet(self, biff8):
-        self.sheets.append( SheetLoader( self, self.target.addsheet(biff8.record.name), biff8.record.startpos ))
+        if self.selected is not None and biff8.record.name not in self.selected:
+            return
+        sheet = SheetLoader( self, self.target.addsheet(biff8.record.name), biff8.record.startpos )
+        self.sheets.append(sheet)
+        self.target.loaders[sheet.sheet.name] = sheet
+
+class StringTable:
+    ''' The shared strings of a workbook, strings are found in one pass over the SST and CONTINUE data
+        and decoded when they are asked for '''
+    def __init__(self, segments, cached=True):
+        parts = []
+        for segment in segments:
+            segment.seek(0)
+            parts.append(segment.read(len(segment)))
+        self.data = bytes().join(parts)
+        self.ends = list(itertools.accumulate( map(len, parts) ))
+        self.offsets = array.array('Q')
+        self.cache = {} if cached else None
+        self.build()
+
+    def build(self):
+        data = self.data
+        pos = 0
+        while pos < len(data):
+            self.offsets.append(pos)
+            pos, string = self.readstring(pos, False)
+
+    def readstring(self, pos, decode):
+        ''' Reads a string at a position, returns the position of the next one and the string if it is decoded '''
+        data = self.data
+        charnum = data[pos] | (data[pos+1] << 8)
+        strmod = data[pos+2]
+        if (strmod & 0x0F6) != 0:
+            raise Exception(f'Not yet implemented modifier {strmod:X} at {pos:X}')
+        pos += 3
+        formatsize = 0
+        if (strmod & 0x08) == 0x08:
+            formatsize = (data[pos] | (data[pos+1] << 8)) * 4
+            pos += 2
+        parts = []
+        while True:
+            wide = (strmod & 0x1) == 1
+            size = 2*charnum if wide else charnum
+            end = self.ends[bisect.bisect_left(self.ends, pos)] if pos < len(data) else pos
+            if pos + size <= end:
+                if decode:
+                    parts.append( data[pos:pos+size].decode('utf-16' if wide else 'ascii') )
+                pos += size
+                break
+            size = end - pos
+            if decode:
+                parts.append( data[pos:end].decode('utf-16' if wide else 'ascii') )
+            charnum -= size//2 if wide else size
+            pos = end
+            strmod = data[pos]
+            pos += 1
+        return pos + formatsize, ''.join(parts) if decode else None
+
+    def __getitem__(self, index):
+        if self.cache is not None and index in self.cache:
+            return self.cache[index]
+        pos, string = self.readstring(self.offsets[index], True)
+        if self.cache is not None:
+            self.cache[index] = string
+        return string
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __iter__(self):
+        return ( self[i] for i in range(len(self)) )
+
+class SharedString:
+    ''' An index into the shared string table that is resolved after the sheet is loaded '''
+    __slots__ = ('index',)
+
+    def __init__(self, index):
+        self.index = index
+
+class SharedStrings:
+    ''' Stands for the string table in worker processes '''
+    def __getitem__(self, index):
+        return SharedString(index)
+
+EMPTY = memoryview(bytes())
 
 class Biff8Record:
-    def __init__(self, rectype, size, reader):
+    ''' A record header and the place of its body in a buffer shared by the records of a stream,
+        the body is sliced only when it is asked for and the record is decoded once '''
+    __slots__ = ('rectype', 'size', 'reader', 'buffer', 'offset', '_record')
+
+    def __init__(self, rectype, size, reader, buffer=EMPTY, offset=0):
         self.rectype = rectype
         self.size = size
         self.reader = reader
-        self.raw = []
+        self.buffer = buffer
+        self.offset = offset
 
     def __repr__(self):
         if self.record == None:
             return "BIFF8 {:04X} of size {:04X}".format(self.rectype, self.size)
         return str(self.record)
 
-    @cached_property
+    @property
+    def raw(self):
+        return self.buffer[self.offset:self.offset+self.size]
+
+    @property
     def record(self):
-        return self.reader.readrecord(self)
+        try:
+            return self._record
+        except AttributeError:
+            self._record = self.reader.readrecord(self)
+            return self._record
+
+class NativeDecoder:
+    ''' Decodes a record of a hot type straight from its raw bytes into the record class of its generic reader.
+        It is used only while the generic reader has the expected fields and no transforms '''
+    def __init__(self, fieldnames, size, decode):
+        self.fieldnames = fieldnames
+        self.size = size
+        self.decode = decode
+
+    def accepts(self, reader):
+        return isinstance(reader, records.PlainRecordReader) and tuple(reader.fieldnames) == self.fieldnames and \
+               len(reader.transforms) == 0 and reader.selector is None
+
+CELLLAYOUT = struct.Struct('<HHH')
+RKLAYOUT = struct.Struct('<HHHI')
+ROWLAYOUT = struct.Struct('<HHHH4xHH')
+FORMULALAYOUT = struct.Struct('<HHH8sHIH')
+DOUBLELAYOUT = struct.Struct('<d')
+
+def decodenumber(reader, raw):
+    data = reader.recordclass(reader)
+    data.row, data.column, data.ixfe = CELLLAYOUT.unpack_from(raw)
+    data.rawvalue = list(raw[6:14])
+    [data.value] = DOUBLELAYOUT.unpack_from(raw, 6)
+    return data
+
+def decoderk(reader, raw):
+    data = reader.recordclass(reader)
+    data.row, data.column, data.ixfe, data.rknum = RKLAYOUT.unpack_from(raw)
+    return data
+
+def decodelabelsst(reader, raw):
+    data = reader.recordclass(reader)
+    data.row, data.column, data.ixfe, data.isst = RKLAYOUT.unpack_from(raw)
+    return data
+
+def decodeblank(reader, raw):
+    data = reader.recordclass(reader)
+    data.row, data.column, data.ixfe = CELLLAYOUT.unpack_from(raw)
+    return data
+
+def decodemulrk(reader, raw):
+    data = reader.recordclass(reader)
+    data.row, data.column, ixfe = CELLLAYOUT.unpack_from(raw)
+    data.rawvalue = reader.fields[2].reader.bytemeta.from_bytes(raw[4:])
+    return data
+
+def decodemulblank(reader, raw):
+    data = reader.recordclass(reader)
+    data.row, data.column, ixfe = CELLLAYOUT.unpack_from(raw)
+    data.rawxf = reader.fields[2].reader.bytemeta.from_bytes(raw[4:])
+    return data
+
+def decoderow(reader, raw):
+    data = reader.recordclass(reader)
+    data.row, data.columnfirst, data.columnlast, data.height, data.flags, data.xfflags = ROWLAYOUT.unpack_from(raw)
+    data.reserved = None
+    return data
+
+def decodeformula(reader, raw):
+    ''' Decodes the fixed part and the formula bytes, the formula streams are made by their generic fields '''
+    data = reader.recordclass(reader)
+    data.row, data.column, data.ixfe, value, data.status, data.cache, data.formulasize = FORMULALAYOUT.unpack_from(raw)
+    if len(raw) < FORMULALAYOUT.size + data.formulasize:
+        return None
+    data.value = list(value)
+    data.rawformula = list(raw[FORMULALAYOUT.size:FORMULALAYOUT.size+data.formulasize])
+    for field in reader.fields[8:]:
+        field.read(None, data)
+    return data
+
+DECODERS = {
+    0x0006: NativeDecoder(('row', 'column', 'ixfe', 'value', 'status', 'cache', 'formulasize', 'rawformula',
+                           'rawformulastream', 'formulastream'), FORMULALAYOUT.size, decodeformula),
+    0x00BD: NativeDecoder(('row', 'column', 'rawvalue'), 4, decodemulrk),
+    0x00BE: NativeDecoder(('row', 'column', 'rawxf'), 4, decodemulblank),
+    0x00FD: NativeDecoder(('row', 'column', 'ixfe', 'isst'), RKLAYOUT.size, decodelabelsst),
+    0x0201: NativeDecoder(('row', 'column', 'ixfe'), CELLLAYOUT.size, decodeblank),
+    0x0203: NativeDecoder(('row', 'column', 'ixfe', 'rawvalue', 'value'), 14, decodenumber),
+    0x0208: NativeDecoder(('row', 'columnfirst', 'columnlast', 'height', 'reserved', 'flags', 'xfflags'), ROWLAYOUT.size, decoderow),
+    0x027E: NativeDecoder(('row', 'column', 'ixfe', 'rknum'), RKLAYOUT.size, decoderk),
+}
 
 class Biff8RecordReader:
+    fieldnames = ('rectype', 'size')
+
     def __init__(self):
         self.bytereader = streams.ByteStreamReader()
+        self.decoders = None
 
     def read(self, datafile):
+        ''' Reads a record, a record inside a run of a mapped file keeps a view of the run and only
+            a record that crosses runs is copied '''
+        getrun = getattr(datafile, 'getrun', None)
+        if getrun is not None:
+            pos = datafile.getpos()
+            run = getrun(pos)
+            if run is not None:
+                first, view = run
+                start = pos - first
+                if start + 4 <= len(view):
+                    size = view[start+2] | (view[start+3] << 8)
+                    if start + 4 + size <= len(view):
+                        datafile.seek(pos + 4 + size)
+                        return Biff8Record(view[start] | (view[start+1] << 8), size, self, view, start + 4)
         header = datafile.read(4)
         if len(header) < 4:
             return Biff8Record(0, 0, self)
-        record = Biff8Record(int.from_bytes(header[0:2], 'little'), int.from_bytes(header[2:4], 'little'), self)
-        record.raw = datafile.read(record.size)
-        return record
+        size = int.from_bytes(header[2:4], 'little')
+        return Biff8Record(int.from_bytes(header[0:2], 'little'), size, self, datafile.read(size))
+
+    def getcolumntype(self, name):
+        if name in ('rectype', 'size'):
+            return 'H'
+        return None
 
     def readsize(self, datafile):
         header = datafile.read(4)
@@ -195,15 +694,42 @@ class Biff8RecordReader:
         datafile.seek(size, os.SEEK_CUR)
         return size
 
+    def skip(self, datafile):
+        self.readsize(datafile)
+
+    def skipkey(self, datafile, name):
+        if name != 'rectype':
+            return getattr(self.read(datafile), name)
+        header = datafile.read(4)
+        datafile.seek(int.from_bytes(header[2:4], 'little'), os.SEEK_CUR)
+        return int.from_bytes(header[0:2], 'little')
+
     @classmethod
     def getreader(cls, module):
         reader = cls()
         reader.mapping = module.gettypemapper('biff8')
         return reader
 
+    def getdecoders(self):
+        ''' Returns the native decoders and the generic readers of the record types they can stand for '''
+        decoders = {}
+        for rectype, decoder in DECODERS.items():
+            if rectype in self.mapping and decoder.accepts(self.mapping[rectype]):
+                decoders[rectype] = (decoder, self.mapping[rectype])
+        return decoders
+
     def readrecord(self, record):
+        if self.decoders is None:
+            self.decoders = self.getdecoders()
+        raw = record.raw
+        if record.rectype in self.decoders:
+            decoder, reader = self.decoders[record.rectype]
+            if len(raw) >= decoder.size:
+                data = decoder.decode(reader, raw)
+                if data is not None:
+                    return data
         if record.rectype in self.mapping:
-            return self.mapping[record.rectype].read(self.bytereader.from_bytes(record.raw))
+            return self.mapping[record.rectype].read(self.bytereader.from_bytes(bytes(raw)))
         return None
 
 class Biff8StreamFormatter(formatter.StreamFormatter):
@@ -242,8 +768,113 @@ class Biff8String:
         reader = cls('short')
         return reader
 
-def bookloader(rawstream):
-    return WorkbookLoader(rawstream)
+STRUCTURES = {}
+
+def getstructure(structure):
+    if structure not in STRUCTURES:
+        STRUCTURES[structure] = records.loadmeta(structure, formatter.getminimal())
+    return STRUCTURES[structure]
+
+def getbookreader(strdef):
+    ''' Returns the reader of the records of the workbook stream of a structure '''
+    for field in strdef.start.fields:
+        if field.name == 'wbstream':
+            return field.reader
+    raise Exception(f'No workbook stream in the structure')
+
+def loadsheets(task):
+    ''' Reads the cells of some sheets of a workbook in a worker process, every sheet is read from the runs
+        of the file that hold it so the structure of the file is not read again. Shared strings stay as indexes '''
+    structure, filename, mapped, ranges, selection = task
+    reader = getbookreader(getstructure(structure))
+    wbloader = WorkbookLoader(None, False, None, selection.get('rows'), selection.get('columns'), True)
+    with open(filename, 'rb') as datafile:
+        source = streams.MappedFile(datafile) if mapped else datafile
+        sheets = {}
+        for name, runs in ranges:
+            loader = SheetLoader(wbloader, Sheet(name), 0)
+            loader.bookstream = reader.read(source)
+            loader.bookstream.source = streams.RunStream(source, runs)
+            loader.bookstream.reset()
+            loader.load()
+            sheets[name] = (loader.sheet.keys, loader.sheet.values)
+        source.close()
+        return sheets
+
+def loadparallel(structure, filename, processes=None, mapped=False, **selection):
+    ''' Loads a workbook reading its sheets in a pool of processes, the string table is resolved once here '''
+    strdef = getstructure(structure)
+    with open(filename, 'rb') as datafile:
+        wbloader = strdef.read(datafile, mapped, deferred=True, **selection).workbookloader
+        workbook = wbloader.target
+        rawstream = wbloader.rawstream
+        offsets = sorted( map(lambda l: l.bookoffset, workbook.loaders.values()) ) + [ len(rawstream) ]
+        ranges = []
+        for name, loader in workbook.loaders.items():
+            stop = next( filter(lambda o: o > loader.bookoffset, offsets), offsets[-1] )
+            ranges.append( (name, rawstream.getfileruns(loader.bookoffset, stop)) )
+        processes = min(processes or os.cpu_count() or 1, max(len(ranges), 1))
+        tasks = [ (structure, filename, mapped, ranges[i::processes], selection) for i in range(processes) ]
+        with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+            for sheets in pool.map(loadsheets, tasks):
+                for name, (keys, values) in sheets.items():
+                    sheet = workbook.loaders[name].sheet
+                    sheet.keys = keys
+                    sheet.values = [ wbloader.stringtable[v.index] if v.__class__ is SharedString else v for v in values ]
+        return workbook
+
+def bookloader(rawstream, deferred=False, sheets=None, rows=None, columns=None, stringindexes=False, cachedstrings=True):
+    return WorkbookLoader(rawstream, deferred, sheets, rows, columns, stringindexes, cachedstrings)
+
+def getrange(reference):
+    ''' Returns the (start, stop) ranges of rows and columns of a reference like A1:F5000 '''
+    bounds = []
+    for cell in reference.upper().split(':'):
+        letters = cell.rstrip('0123456789')
+        digits = cell[len(letters):]
+        if len(letters) == 0 or len(digits) == 0 or not letters.isalpha() or int(digits) == 0:
+            raise Exception(f'Bad cell reference {reference}')
+        column = 0
+        for letter in letters:
+            column = column * 26 + ord(letter) - ord('A') + 1
+        bounds.append( (int(digits) - 1, column - 1) )
+    if len(bounds) == 1:
+        bounds.append(bounds[0])
+    if len(bounds) != 2:
+        raise Exception(f'Bad cell reference {reference}')
+    (firstrow, firstcol), (lastrow, lastcol) = bounds
+    return (min(firstrow, lastrow), max(firstrow, lastrow) + 1), (min(firstcol, lastcol), max(firstcol, lastcol) + 1)
+
+RKMASK = bytes( b & 0xF7 for b in range(256) )
+RKFLAGS = bytes( b & 0x03 for b in range(256) )
+
+def readrknums(raw):
+    ''' Decodes the XF and RK entries of a MULRK record at once, the values are the same as of SheetLoader.readrknum.
+        The bytes of the RK numbers are gathered with strided slices into the high halves of doubles '''
+    count = len(raw) // 6
+    raw = bytes(raw[:count*6])
+    buffer = bytearray(8 * count)
+    buffer[4::8] = raw[2::6].translate(RKMASK)
+    buffer[5::8] = raw[3::6]
+    buffer[6::8] = raw[4::6]
+    buffer[7::8] = raw[5::6]
+    doubles = array.array('d', buffer)
+    if sys.byteorder != 'little':
+        doubles.byteswap()
+    values = doubles.tolist()
+    flags = raw[2::6].translate(RKFLAGS)
+    if flags.count(0) == count:
+        return values
+    buffer = bytearray(4 * count)
+    for i in range(4):
+        buffer[i::4] = raw[2+i::6]
+    rknums = array.array('I', buffer)
+    if sys.byteorder != 'little':
+        rknums.byteswap()
+    values = [ rknum >> 2 if flag & 0x02 else value for flag, rknum, value in zip(flags, rknums, values) ]
+    if b'\x01' in flags or b'\x03' in flags:
+        values = [ value / 100 if flag & 0x01 else value for flag, value in zip(flags, values) ]
+    return values
 
 def getdouble(rawvalue):
     [value] = struct.unpack('d', bytes(rawvalue))
@@ -252,14 +883,14 @@ def getdouble(rawvalue):
 def longmsunicode(rawdata):
     method = 'ascii' if (rawdata[2] & 0x80) == 0 else 'utf-16'
     size = int.from_bytes(rawdata[0:2], 'little')
-    return rawdata[3:3+size].decode(method)
+    return bytes(rawdata[3:3+size]).decode(method)
 
 def shortmsunicode(rawdata):
     method = 'ascii' if (rawdata[1] & 0x1) == 0 else 'utf-16'
     size = rawdata[0]
     if method == 'utf-16':
         size *= 2
-    return rawdata[2:2+size].decode(method)
+    return bytes(rawdata[2:2+size]).decode(method)
 
 def loadmeta(module):
     module.addtypes( { 'biff8': Biff8RecordReader.getreader, 'shortmsunicode': Biff8String.getshortreader } )
@@ -1,15 +1,91 @@
 import os
+import sys
+import array
+import collections
+import bisect
+import itertools
 import streams
 
 ENDOFCHAIN = 0xFFFFFFFE
+NOSTREAM = 0xFFFFFFFF
+STORAGE = 1
+STREAM = 2
+CACHESIZE = 1024
+
+class SectorCache:
+    ''' Least recently used sectors of a file, shared by all chain streams over the file '''
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.sectors = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def read(self, datafile, start, size, sectsize):
+        ''' Reads a range of adjacent sectors, the missing ones are read from the file at once '''
+        first = start - start % sectsize
+        end = start + size
+        if end <= first + sectsize and first in self.sectors:
+            self.hits += 1
+            self.sectors.move_to_end(first)
+            return self.sectors[first][start-first:end-first]
+        if (end - first) // sectsize > self.capacity // 4:
+            datafile.seek(start)
+            return datafile.read(size)
+        parts = []
+        missing = []
+        for sect in range(first, end, sectsize):
+            data = self.sectors.get(sect)
+            if data is None:
+                self.misses += 1
+                missing.append(sect)
+                continue
+            self.hits += 1
+            self.sectors.move_to_end(sect)
+            if len(missing) > 0:
+                parts.append(self.fetch(datafile, missing, sectsize))
+                missing = []
+            parts.append(data)
+        if len(missing) > 0:
+            parts.append(self.fetch(datafile, missing, sectsize))
+        start -= first
+        if len(parts) == 1:
+            return parts[0][start:start+size]
+        return bytes().join(parts)[start:start+size]
+
+    def fetch(self, datafile, missing, sectsize):
+        datafile.seek(missing[0])
+        data = datafile.read(len(missing) * sectsize)
+        for i, sect in enumerate(missing):
+            self.sectors[sect] = data[i*sectsize:(i+1)*sectsize]
+        while len(self.sectors) > self.capacity:
+            self.sectors.popitem(last=False)
+        return data
+
+    def __repr__(self):
+        return f'{len(self.sectors)} of {self.capacity} sectors, {self.hits} hits, {self.misses} misses'
+
+def setcache(datafile, capacity):
+    ''' Sets the capacity of the sector cache of a file in sectors, zero disables the cache '''
+    setattr(datafile, 'sectorcache', SectorCache(capacity) if capacity > 0 else False)
+    return datafile.sectorcache
+
+def getcache(datafile):
+    ''' Returns the sector cache shared by the streams of a file, mapped files are not cached '''
+    if isinstance(datafile, streams.MappedFile):
+        return None
+    if not hasattr(datafile, 'sectorcache'):
+        setcache(datafile, CACHESIZE)
+    return datafile.sectorcache or None
 
 class SectorChainStream:
     def __init__(self, meta, datafile):
         self._meta = meta
         self.datafile = datafile
+        self.cache = None
         self.sectors = None
         self.pos = 0
         self.size = None
+        self.runs = None
 
     def seek(self, delta, postype=os.SEEK_SET):
         if postype == os.SEEK_END:
@@ -25,25 +101,85 @@ class SectorChainStream:
         return self.pos
 
     def read(self, size):
-        acc = bytes()
         self.acquiresectors(self.pos+size)
-        isect = self.pos // self.posbase
-        istart = (self.pos % self.posbase)
-        while size >= 0:
-            chunk = min(size, self.posbase-istart)
-            if self.size != None:
-                chunk = min(chunk, self.size-self.pos)
-                if chunk <= 0:
-                    break
-            self.datafile.seek(self.sectors[isect] + istart)
-            acc += self.datafile.read(chunk)
-            self.pos += chunk
-            size -= chunk
-            isect += 1
-            if isect >= len(self.sectors):
+        isect, istart = divmod(self.pos, self.posbase)
+        if 0 < size <= self.posbase - istart and isect < len(self.sectors) and (self.size is None or self.pos + size <= self.size):
+            self.pos += size
+            return self.readrun(self.sectors[isect] + istart, size)
+        runs = self.getruns(size)
+        if len(runs) == 0:
+            return bytes()
+        if len(runs) == 1 or self.cache is not None:
+            parts = [ self.readrun(start, chunk) for start, chunk in runs ]
+            return parts[0] if len(parts) == 1 else bytes().join(parts)
+        buffer = bytearray( sum(map(lambda r: r[1], runs)) )
+        view = memoryview(buffer)
+        offset = 0
+        for start, chunk in runs:
+            self.datafile.seek(start)
+            if hasattr(self.datafile, 'readinto'):
+                got = self.datafile.readinto(view[offset:offset+chunk])
+            else:
+                data = self.datafile.read(chunk)
+                got = len(data)
+                view[offset:offset+got] = data
+            offset += got
+            if got < chunk:
+                del view
+                del buffer[offset:]
                 break
-            istart = 0
-        return acc
+        return buffer
+
+    def getrun(self, pos):
+        ''' Returns the run of adjacent sectors of a mapped file that holds a position as the position where
+            the run starts in the stream and a view of the mapping, otherwise None so that nothing is read ahead '''
+        if self.runs is None:
+            self.runs = False
+            if isinstance(self.datafile, streams.MappedFile):
+                runs = self.getfileruns(0, len(self))
+                firsts = list(itertools.accumulate( map(lambda r: r[1], runs), initial=0 ))[:-1]
+                views = [ self.datafile.source[start:start+chunk] for start, chunk in runs ]
+                self.runs = (firsts, views)
+        if not self.runs:
+            return None
+        firsts, views = self.runs
+        irun = bisect.bisect_right(firsts, pos) - 1
+        if irun < 0 or pos >= firsts[irun] + len(views[irun]):
+            return None
+        return firsts[irun], views[irun]
+
+    def getfileruns(self, start, stop):
+        ''' Returns the runs of the file that hold the stream from start to stop as [start, size] pairs '''
+        current = self.pos
+        self.acquiresectors(stop)
+        self.pos = start
+        runs = self.getruns(stop - start)
+        self.pos = current
+        return runs
+
+    def readrun(self, start, size):
+        if self.cache is not None:
+            return self.cache.read(self.datafile, start, size, self.sectsize)
+        self.datafile.seek(start)
+        return self.datafile.read(size)
+
+    def getruns(self, size):
+        ''' Maps the next size bytes to runs of physically adjacent sectors and moves the position past them '''
+        runs = []
+        end = min( self.pos + max(size, 0), len(self.sectors) * self.posbase )
+        if self.size != None:
+            end = min(end, self.size)
+        while self.pos < end:
+            isect = self.pos // self.posbase
+            istart = self.pos % self.posbase
+            chunk = min(end - self.pos, self.posbase - istart)
+            start = self.sectors[isect] + istart
+            if len(runs) > 0 and runs[-1][0] + runs[-1][1] == start:
+                runs[-1][1] += chunk
+            else:
+                runs.append( [start, chunk] )
+            self.pos += chunk
+        return runs
 
     def __len__(self):
         if self.size is None:
@@ -61,6 +197,7 @@ class SectorChainStream:
         if not self.sectors is None:
             return False
         self.sectsize = 1 << self.header.sectorshift
+        self.cache = getcache(self.datafile)
         self.pos = 0
         return True
 
@@ -105,8 +242,7 @@ class DIFatSectorChainStream(SectorChainStream):
         else:
             maxsect = min( lastpos // self.posbase, self.header.numdifatsect)
         while len(self.sectors) < maxsect:
-            self.datafile.seek( self.sectors[-1], os.SEEK_SET)
-            sect = self.datafile.read(self.sectsize)
+            sect = self.readrun(self.sectors[-1], self.sectsize)
             nextsect = int.from_bytes(sect[-4:], 'little')
             if nextsect == ENDOFCHAIN:
                 raise Exception('Unexpected end of chain')
@@ -156,9 +292,13 @@ class DataStream(SectorChainStream):
     def reset(self):
         if not super().reset():
             return False
+        self.posbase = self.sectsize
+        if isinstance(self.fat, FatTable):
+            self.isectors = self.fat.getchain(self.start) + [ ENDOFCHAIN ]
+            self.sectors = list(map( self.sectorpos, self.isectors[:-1] ))
+            return True
         self.sectors = [ self.sectorpos(self.start) ]
         self.isectors = [ self.start ]
-        self.posbase = self.sectsize
         return True
 
     def acquiresectors(self, lastpos):
@@ -178,6 +318,130 @@ class DataStreamReader(streams.StreamReader):
     def read(self, datafile):
         return DataStream(self, datafile)
 
+class FatTable:
+    ''' The whole FAT loaded at once, resolves sector chains without reading the FAT stream again '''
+    def __init__(self, meta):
+        self._meta = meta
+        self.entries = array.array('I')
+
+    def reset(self):
+        self.entries = array.array('I')
+        self.source.seek(0)
+        self.entries.frombytes( self.source.read(len(self.source)) )
+        if sys.byteorder != 'little':
+            self.entries.byteswap()
+        self.source.seek(0)
+
+    def getchain(self, start):
+        ''' Returns the sectors of a chain, a chain that leaves the FAT or loops is an error '''
+        chain = []
+        entries = self.entries
+        sector = start
+        while sector != ENDOFCHAIN:
+            if sector >= len(entries):
+                raise Exception(f'Sector {sector:08X} in the chain at {start:08X} is out of the FAT')
+            if len(chain) >= len(entries):
+                raise Exception(f'The chain at {start:08X} has a cycle')
+            chain.append(sector)
+            sector = entries[sector]
+        return chain
+
+    def __getitem__(self, key):
+        return self.entries[key]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return f'FAT of {len(self.entries)} entries'
+
+class FatTableReader(streams.StreamReader):
+    def read(self, datafile):
+        return FatTable(self)
+
+class Directory:
+    ''' A path index over the directory entries, a stream is created only when it is opened '''
+    def __init__(self, meta, datafile):
+        self._meta = meta
+        self.datafile = datafile
+        self.items = None
+        self.paths = None
+        self.names = []
+
+    def reset(self):
+        self.items = None
+        self.paths = None
+        self.names = []
+
+    def getindex(self):
+        ''' Builds the index of paths walking the tree of entries once '''
+        if self.paths is not None:
+            return self.paths
+        self.items = self.entries.read( self.entries.seek(0, os.SEEK_END) - self.entries.seek(0) )
+        self.paths = {}
+        self.names = []
+        visited = set()
+        stack = [ (self.items[0].child, '') ] if len(self.items) > 0 else []
+        while len(stack) > 0:
+            ientry, parent = stack.pop()
+            if ientry == NOSTREAM:
+                continue
+            if ientry >= len(self.items) or ientry in visited:
+                raise Exception(f'Bad directory entry {ientry:08X} under "{parent}"')
+            visited.add(ientry)
+            entry = self.items[ientry]
+            path = parent + entry.name
+            self.paths[path.upper()] = ientry
+            self.names.append(path)
+            stack.append( (entry.left, parent) )
+            stack.append( (entry.right, parent) )
+            if entry.type == STORAGE:
+                stack.append( (entry.child, path + '/') )
+        return self.paths
+
+    def find(self, path):
+        ''' Returns the entry of a path, names of the path are separated by slashes and compared ignoring case '''
+        index = self.getindex()
+        key = path.strip('/').upper()
+        return self.items[index[key]] if key in index else None
+
+    def open(self, path):
+        ''' Creates a data stream of the entry at the path, streams kept in the mini stream are not supported '''
+        entry = self.find(path)
+        if entry is None:
+            raise Exception(f'Stream "{path}" not found')
+        if entry.type != STREAM:
+            raise Exception(f'Entry "{path}" of type {entry.type} is not a stream')
+        if entry.size < self.header.ministreamcutoff:
+            raise Exception(f'Stream "{path}" of size {entry.size} is in the mini stream, which is not supported')
+        stream = DataStream(self._meta.datastream, self.datafile)
+        stream.header = self.header
+        stream.fat = self.fat
+        stream.start = entry.start
+        stream.size = entry.size
+        stream.reset()
+        return stream
+
+    def __contains__(self, path):
+        return self.find(path) is not None
+
+    def __iter__(self):
+        self.getindex()
+        return iter(self.names)
+
+    def __repr__(self):
+        return '\n'.join(self)
+
+class DirectoryReader(streams.StreamReader):
+    def read(self, datafile):
+        return Directory(self, datafile)
+
+    @classmethod
+    def getreader(cls, module):
+        reader = super().getreader(module)
+        reader.datastream = DataStreamReader.getreader(module)
+        return reader
+
 class FatSectorStream(streams.CombinedStream):
     def __init__(self, meta, inheader, chain):
         super().__init__(meta)
@@ -202,4 +466,5 @@ class FatSectorStreamReader(streams.StreamReader):
 
 def loadmeta(module):
     module.addtypes( { 'sectorchain': SectorChainStreamReader.getreader, 'difatstream': FatSectorStreamReader.getreader,
-                       'fatstream': FatStreamReader.getreader, 'datastream': DataStreamReader.getreader } )
+                       'fatstream': FatStreamReader.getreader, 'datastream': DataStreamReader.getreader,
+                       'fattable': FatTableReader.getreader, 'directory': DirectoryReader.getreader } )
@@ -1,3 +1,5 @@
+import expression
+
 class Collector:
     def __init__(self, first):
         self.data = [ first ]
@@ -48,18 +50,18 @@ class Parser:
         self.start = None
         self.stream = None
         self.nodes = []
+        self.namespace = { 'self': self }
 
     def transform(self, environ, data=None, operands=None):
-        self.stream = StreamLookAhead(eval(self.source, environ))
+        self.stream = StreamLookAhead(self.source.evaluate(environ))
         if self.context != None and data == None:
-            data = eval(self.context, environ)
+            data = self.context.evaluate(environ)
         self.nodes = [ Node(self.start, data) ]
         while len(self.nodes) > 0:
             top = self.nodes[-1]
             action = top.state.default
             for a in top.state.actions:
-                y = eval(a.condition, {'self':self})
-                if eval(a.condition, {'self':self}):
+                if a.condition.evaluate(self.namespace):
                     action = a
                     break
             top.call(action.function, self.stream[0])
@@ -114,16 +116,17 @@ class Push:
 
 class Action:
     def __init__(self):
-        self.condition = ""
+        self.condition = None
         self.action = None
         self.function = None
         self.push = None
 
 class ParserLoader:
-    def __init__(self, module):
+    def __init__(self, module, where):
         self.parser = Parser()
         self.states = {}
         self.module = module
+        self.where = where
 
     def getaction(self, ydef, default):
         if 'action' in ydef:
@@ -147,7 +150,7 @@ class ParserLoader:
         self.loadstatedefault(state, ystate['default'])
         for yact in ystate['actions']:
             action = Action()
-            action.condition = 'self.stream' + yact['on']
+            action.condition = expression.load('self.stream' + yact['on'], self.where + ', state ' + state.name)
             if 'do' in yact:
                 action.function = yact['do']
             action.action = self.getaction(yact, self.parser.next)
@@ -167,16 +170,16 @@ class ParserLoader:
                 self.loadstate(ydef)
 
     @classmethod
-    def load(cls, ymeta, module):
-        loader = cls(module)
-        loader.parser.source = ymeta['parse']
+    def load(cls, ymeta, module, where):
+        loader = cls(module, where)
+        loader.parser.source = expression.load(ymeta['parse'], where)
         if 'with' in ymeta:
-            loader.parser.context = ymeta['with']
+            loader.parser.context = expression.load(ymeta['with'], where + ', with')
         loader.loadmachine(ymeta['machine'])
         return loader.parser
 
-def loadparser(ymeta, module):
-    return ParserLoader.load(ymeta, module)
+def loadparser(ymeta, module, where='parse'):
+    return ParserLoader.load(ymeta, module, where)
 
 def collector(first):
     return Collector(first)
\ No newline at end of file
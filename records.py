@@ -2,16 +2,23 @@ import yaml
 import os
 import sys
 import importlib
+import struct
+from collections.abc import Mapping
 import formatter
 import streams
 import transform
 import parser
 import selector
+import compiler
+import expression
 
 class FieldReader:
     def __init__(self):
         self.preread = []
         self.postread = []
+        self.count = None
+        self.localref = None
+        self.globalref = None
 
     def __repr__(self):
         return self.name
@@ -24,8 +31,55 @@ class FieldReader:
             pr(data, fvalue)
         setattr(data, self.name, fvalue)
 
+    def skip(self, datafile, data):
+        ''' Moves past the field value, a lazy field is decoded later by decode '''
+        if isinstance(self.reader, FunctionReader):
+            return
+        if self.count is not None:
+            datafile.seek(self.count.evaluate(data.getview()) * self.reader.simple.getsize(), os.SEEK_CUR)
+        else:
+            skip(self.reader, datafile)
+
+    def decode(self, datafile, data, names=None):
+        ''' Decodes the value of a lazy field at the current position of the data file, expressions see
+            only the given names as a field read in order sees only the fields before it '''
+        view = data.getview() if names is None else FieldView(data, names)
+        if isinstance(self.reader, FunctionReader):
+            return self.reader.func.evaluate(view, self.reader.statctx)
+        if self.count is not None:
+            count = self.count.evaluate(view)
+            return [ self.reader.simple.read(datafile) for i in range(count) ]
+        return self.reader.read(datafile)
+
+    def canlazy(self):
+        ''' Checks that the field can be skipped at read time and decoded on access '''
+        if self.localref is not None or self.globalref is not None:
+            return False
+        if isinstance(self.reader, FunctionReader):
+            return True
+        if self.count is not None:
+            return isinstance(self.reader.simple, IntReader) and self.reader.simple.getformat() is not None
+        if hasattr(self.reader, 'getformat'):
+            return False
+        return canskip(self.reader)
+
+    def getnames(self):
+        ''' Returns the names the field refers to while it is read '''
+        names = set()
+        if isinstance(self.reader, FunctionReader):
+            names.update(self.reader.func.getnames())
+        if self.count is not None:
+            names.update(self.count.getnames())
+        for ref in (self.localref, self.globalref):
+            if ref is not None:
+                for xref in ref.params.values():
+                    names.update(xref.getnames())
+        return names
+
 
 class PlainRecord:
+    __slots__ = ('_meta',)
+
     def __init__(self, meta):
         self._meta = meta
 
@@ -35,23 +89,135 @@ class PlainRecord:
     def getfields(self):
         return self._meta.getfields(self)
 
+    def getview(self):
+        return FieldView(self, self._meta.fieldset)
+
+    def __reduce__(self):
+        return (restorerecord, (self._meta.structurekey, self._meta.name, self.getfields()))
+
+class LazyRecord(PlainRecord):
+    ''' A record which decodes some of its fields on first access '''
+    __slots__ = ('_lazy',)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self._meta.decodefield(self, name)
+
+class FieldView(Mapping):
+    ''' A read-only mapping over the fields of a record, used as an evaluation namespace '''
+    __slots__ = ('data', 'names')
+
+    def __init__(self, data, names):
+        self.data = data
+        self.names = names
+
+    def __getitem__(self, key):
+        if key in self.names:
+            try:
+                return getattr(self.data, key)
+            except AttributeError:
+                pass
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter( [ name for name in self.names if hasattr(self.data, name) ] )
+
+    def __len__(self):
+        return sum( 1 for name in self.names if hasattr(self.data, name) )
+
 class PlainRecordReader:
     def __init__(self):
         self.fields = []
         self.transforms = []
         self.selector = None
+        self.compiled = None
+        self.fieldnames = []
+        self.fieldset = frozenset()
+        self.recordclass = PlainRecord
+        self.skipsize = None
+        self.lazyfields = {}
+        self.structurekey = None
 
     def read(self, datafile):
         pos = datafile.getpos()
-        data = PlainRecord(self)
-        for f in self.fields:
-            f.read(datafile, data)
+        data = self.recordclass(self)
+        if len(self.lazyfields) > 0:
+            offsets = []
+            for f in self.fields:
+                if f.name in self.lazyfields:
+                    offsets.append(None if isinstance(f.reader, FunctionReader) else datafile.getpos())
+                    f.skip(datafile, data)
+                else:
+                    f.read(datafile, data)
+            data._lazy = (datafile, offsets)
+        else:
+            for f in self.fields:
+                f.read(datafile, data)
         for t in self.transforms:
             t.transform(self.getfields(data))
         if self.selector != None:
             data = self.selector.select(datafile, pos, data)
         return data
 
+    def skip(self, datafile):
+        ''' Moves past a record without decoding it if the record has a static layout '''
+        if not self.canskip():
+            self.read(datafile)
+        else:
+            datafile.seek(self.skipsize, os.SEEK_CUR)
+
+    def canskip(self):
+        if self.skipsize is None:
+            layout = RecordLayout.load(self)
+            self.skipsize = layout.struct.size if layout is not None else False
+        return self.skipsize is not False
+
+    def makelazy(self):
+        ''' Selects the fields that are decoded on first access, fields needed while the record is read stay eager '''
+        if len(self.transforms) > 0 or not all( map(str.isidentifier, self.fieldnames) ):
+            return
+        eager = set()
+        if self.selector is not None:
+            eager.update(self.selector.selector.getnames())
+        lazy = []
+        for f in reversed(self.fields):
+            if f.name not in eager and f.canlazy():
+                lazy.append(f)
+                if f.count is not None:
+                    eager.update(f.count.getnames())
+            else:
+                eager.update(f.getnames())
+        lazy = [ f for f in lazy if f.name not in eager ]
+        if len(lazy) == 0 or len(lazy) != len(set( map(lambda f: f.name, lazy) )):
+            return
+        self.lazyfields = {}
+        for f in reversed(lazy):
+            before = frozenset( map(lambda x: x.name, self.fields[:self.fields.index(f)]) )
+            self.lazyfields[f.name] = (f, len(self.lazyfields), before)
+        self.recordclass = makerecordclass(self.name, self.fieldnames, True)
+
+    def decodefield(self, data, name):
+        ''' Decodes a lazy field and keeps its value in the record '''
+        if name not in self.lazyfields:
+            raise AttributeError(name)
+        try:
+            datafile, offsets = data._lazy
+        except AttributeError:
+            raise AttributeError(name) from None
+        field, index, before = self.lazyfields[name]
+        if offsets[index] is None:
+            value = field.decode(datafile, data, before)
+        else:
+            pos = datafile.getpos()
+            datafile.seek(offsets[index])
+            try:
+                value = field.decode(datafile, data, before)
+            finally:
+                datafile.seek(pos)
+        setattr(data, name, value)
+        return value
+
     def prettyprint(self, data):
         return self.name + ":\n"+"\n".join( map( lambda x: "    {0}: {1}".format(x.name, self.printfield(x, getattr(data, x.name)) ), self.fields) )
 
@@ -63,9 +229,9 @@ class PlainRecordReader:
 
     def getfields(self, data):
         ret = {}
-        for f in self.fields:
-            if hasattr(data, f.name):
-                ret[f.name] = getattr(data, f.name)
+        for name in self.fieldnames:
+            if hasattr(data, name):
+                ret[name] = getattr(data, name)
         return ret
 
     def getsize(self):
@@ -74,6 +240,12 @@ class PlainRecordReader:
             size += f.reader.getsize()
         return size
 
+    def getcolumntype(self, name):
+        for f in self.fields:
+            if f.name == name and f.count is None and isinstance(f.reader, IntReader):
+                return f.reader.getformat()
+        return None
+
     def getreader(self, loader):
         return self
 
@@ -81,59 +253,70 @@ class PlainRecordReader:
     def loadreader(cls, name, yrec, module):
         prec = PlainRecordReader()
         prec.name = module.namespace + name
+        where = 'record ' + prec.name
         for yfield in yrec:
             if 'field' in yfield or 'set' in yfield:
-                prec.fields.append( cls.loadfield(yfield, module)  )
+                prec.fields.append( cls.loadfield(yfield, module, where)  )
             elif 'transform' in yfield:
-                prec.transforms.append( transform.loadtransformer(yfield, module) )
+                prec.transforms.append( transform.loadtransformer(yfield, module, where + ', transform') )
             elif 'parse' in yfield:
-                prec.transforms.append( parser.loadparser(yfield, module) )
+                prec.transforms.append( parser.loadparser(yfield, module, where + ', parse') )
             elif 'selection' in yfield:
-                prec.selector = selector.loadselector(yfield['selection'], module)
+                prec.selector = selector.loadselector(yfield['selection'], module, where + ', selection')
+        prec.fieldnames = list(dict.fromkeys( map(lambda f: f.name, prec.fields) ))
+        prec.fieldset = frozenset(prec.fieldnames)
+        prec.recordclass = makerecordclass(prec.name, prec.fieldnames)
+        prec.structurekey = module.loader.structure.key
+        RECORDS[(prec.structurekey, prec.name)] = prec
         return prec
 
     @classmethod
-    def loadfield(cls, yfield, module):
+    def loadfield(cls, yfield, module, where='record'):
         field = FieldReader()
         field.name = yfield['field'] if 'field' in yfield else yfield['set']
+        where = where + ', field ' + field.name
         if 'function' in yfield:
-            field.reader = FunctionReader(yfield['function'], module.getfunctions())
+            field.reader = FunctionReader(expression.load(yfield['function'], where), module.getfunctions())
             field.preread.append( field.reader.setcontext )
             field.formatter = str
         else:
             field.reader = module.getreader(yfield['type'], LoaderXRef(field, 'reader', meta=yfield))
             field.formatter = module.loader.formatter.get(yfield['type'])
             if 'count' in yfield:
+                field.count = expression.load(yfield['count'], where + ', count')
                 reader = ArrayReader(0)
-                field.preread.append( lambda context: reader.evalcount(yfield['count'], context) )
+                field.preread.append( lambda context: reader.evalcount(field.count, context) )
                 reader.simple = field.reader
                 basefmt = field.formatter
                 field.formatter = lambda x: formatter.arrayformatter(x, basefmt)
                 field.reader = reader
             else:
                 if 'params' in yfield:
-                    cls.loadparam(module.loader, field, yfield['params'])
+                    cls.loadparam(module.loader, field, yfield['params'], where)
                 if hasattr(field.reader, 'loadmeta'):
                     field.reader.loadmeta(module, yfield)
         return field
 
     @classmethod
-    def loadparam(cls, loader, field, yparams):
+    def loadparam(cls, loader, field, yparams, where):
         grx = ReaderXRef()
         lrx = LocalRef()
         for yparam in yparams:
+            reference = expression.load(yparam['reference'], where + ', param ' + yparam['name'])
             if 'global' in yparam and yparam['global']:
-                grx.addparam(yparam['name'], yparam['reference'])
+                grx.addparam(yparam['name'], reference)
             else:
-                lrx.addparam(yparam['name'], yparam['reference'])
+                lrx.addparam(yparam['name'], reference)
         if len(lrx) > 0:
+            field.localref = lrx
             if len(grx) > 0:
                 field.postread.append( lambda context, instance: lrx.resolve(context, instance, False) )
             else:
                 field.postread.append( lambda context, instance: lrx.resolve(context, instance, True) )
         if len(grx) > 0:
+            field.globalref = grx
             loader.addreadxref(grx)
-            field.postread.append( lambda context, instance: rx.addinstance(instance) )
+            field.postread.append( lambda context, instance: grx.addinstance(instance) )
 
 class FreeReader:
     def __init__(self, count):
@@ -146,6 +329,9 @@ class FreeReader:
     def getsize(self):
         return self.count
 
+    def getformat(self):
+        return '{0}x'.format(self.count)
+
 class BytesReader:
     def __init__(self, count):
         self.count = count
@@ -156,6 +342,9 @@ class BytesReader:
     def getsize(self):
         return self.count
 
+    def getformat(self):
+        return '{0}s'.format(self.count)
+
 class ArrayReader:
     def __init__(self, count):
         self.count = count
@@ -167,7 +356,116 @@ class ArrayReader:
         return ret
 
     def evalcount(self, ecount, context):
-        self.count = eval(ecount, vars(context))
+        self.count = ecount.evaluate(context.getview())
+
+    def getsize(self):
+        return self.count * self.simple.getsize()
+
+    def getformat(self):
+        if not isinstance(self.simple, IntReader) or self.simple.getformat() is None:
+            return None
+        return '{0}{1}'.format(self.count, self.simple.getformat())
+
+INTFORMATS = { 1: 'B', 2: 'H', 4: 'I', 8: 'Q' }
+
+class ValueLayout:
+    ''' Static layout of a simple fixed-width reader '''
+    def __init__(self, reader):
+        self.struct = struct.Struct('<' + reader.getformat())
+        self.isarray = isinstance(reader, ArrayReader)
+
+    def make(self, values):
+        if self.isarray:
+            return list(values)
+        return values[0] if len(values) > 0 else None
+
+    def getindexes(self, fields):
+        if self.isarray or list(fields) != ['value'] or len(self.struct.format) == 0:
+            return None
+        return { 'value': 0 }
+
+class RecordLayout:
+    ''' Static layout of a plain record, its fixed-width fields are decoded with a single struct '''
+    def __init__(self, reader, fields, formats):
+        self.reader = reader
+        self.fields = fields
+        self.struct = struct.Struct('<' + ''.join(formats))
+
+    def make(self, values):
+        data = self.reader.recordclass(self.reader)
+        for name, start, stop, func in self.fields:
+            if func is not None:
+                setattr(data, name, func.func.evaluate(data.getview(), func.statctx))
+            elif stop is None:
+                setattr(data, name, values[start] if start is not None else None)
+            else:
+                setattr(data, name, list(values[start:stop]))
+        return data
+
+    def getindexes(self, fields):
+        ''' Maps fields to their positions in the unpacked values, None if a field is not a single value '''
+        indexes = {}
+        for name in fields:
+            for fname, start, stop, func in self.fields:
+                if fname == name and start is not None and stop is None and func is None:
+                    indexes[name] = start
+            if name not in indexes:
+                return None
+        return indexes
+
+    @classmethod
+    def load(cls, reader):
+        if len(reader.transforms) > 0 or reader.selector is not None:
+            return None
+        fields = []
+        formats = []
+        ivalue = 0
+        for f in reader.fields:
+            if f.count is not None or f.localref is not None or f.globalref is not None:
+                return None
+            if isinstance(f.reader, FunctionReader):
+                fields.append( (f.name, None, None, f.reader) )
+                continue
+            if isinstance(f.reader, PlainRecordReader) or not hasattr(f.reader, 'getformat'):
+                return None
+            fmt = f.reader.getformat()
+            if fmt is None:
+                return None
+            count = len(struct.Struct('<' + fmt).unpack(bytes(f.reader.getsize())))
+            if isinstance(f.reader, ArrayReader):
+                fields.append( (f.name, ivalue, ivalue+count, None) )
+            else:
+                fields.append( (f.name, ivalue if count > 0 else None, None, None) )
+            formats.append(fmt)
+            ivalue += count
+        return cls(reader, fields, formats)
+
+def skip(reader, datafile):
+    ''' Moves past a record, readers that are able to do it without decoding implement skip '''
+    if hasattr(reader, 'skip'):
+        reader.skip(datafile)
+    else:
+        reader.read(datafile)
+
+def skipkey(reader, datafile, name):
+    ''' Moves past a record and returns its discriminator, readers that take it from the header implement skipkey '''
+    if hasattr(reader, 'skipkey'):
+        return reader.skipkey(datafile, name)
+    return getattr(reader.read(datafile), name)
+
+def canskip(reader):
+    ''' Checks that a reader moves past its data without decoding it '''
+    if isinstance(reader, PlainRecordReader):
+        return reader.canskip()
+    return hasattr(reader, 'skip')
+
+def getlayout(reader):
+    ''' Returns the static layout of a reader or None if it has to be read field by field '''
+    if isinstance(reader, PlainRecordReader):
+        return RecordLayout.load(reader)
+    if hasattr(reader, 'getformat') and reader.getformat() is not None:
+        return ValueLayout(reader)
+    return None
 
 class Structure:
     def __init__(self):
@@ -177,8 +475,18 @@ class Structure:
         self.pymodules = {}
         self.xrefs = []
         self.target = None
-
-    def read(self, datafile):
+        self.params = {}
+        self.key = None
+
+    def read(self, datafile, mapped=False, **params):
+        ''' Reads the start record, parameters declared by the structure are visible to expressions as global names '''
+        self.functions.update(self.params)
+        for name, value in params.items():
+            if name not in self.params:
+                raise Exception(f'Unknown parameter {name}')
+            self.functions[name] = value
+        if mapped:
+            datafile = streams.MappedFile(datafile)
         if not hasattr(datafile, 'getpos'):
             setattr(datafile, 'getpos', lambda: datafile.tell())
         root = self.start.read(datafile)
@@ -190,7 +498,7 @@ class Structure:
     def gettarget(self, obj):
         if self.target == None:
             return obj
-        return eval(self.target, obj.getfields())
+        return self.target.evaluate(obj.getfields())
 
     def __repr__(self):
         return '\n'.join( map(str, self.records.values()) )
@@ -226,13 +534,9 @@ class LocalRef:
         self.params[name] = xref
 
     def resolve(self, instance, field, reset):
-        if hasattr(instance, 'getfields'):
-            context = instance.getfields()
-        else:
-            context = vars(instance)
+        context = expression.getcontext(instance)
         for name, xref in self.params.items():
-            value = eval(xref, context)
-            setattr(field, name, value)
+            setattr(field, name, xref.evaluate(context))
         if reset:
             field.reset()
 
@@ -252,7 +556,7 @@ class ReaderXRef:
 
     def resolve(self, root):
         for name, xref in self.params.items():
-            value = eval(xref, root)
+            value = xref.evaluate(root)
             for instance in self.instances:
                 setattr(instance, name, value)
         for instance in self.instances:
@@ -288,16 +592,22 @@ class IntReader:
     def getsize(self):
         return self.size
 
+    def getformat(self):
+        return INTFORMATS.get(self.size)
+
+    def getcolumntype(self, name):
+        return self.getformat()
+
 class FunctionReader:
     def __init__(self, func, statctx):
         self.func = func
         self.statctx = statctx
 
     def setcontext(self, instance):
-        self.context = instance.getfields()
+        self.context = instance.getview()
 
     def read(self, datafile):
-        return eval(self.func, self.context, self.statctx)
+        return self.func.evaluate(self.context, self.statctx)
 
     def getsize(self):
         return 0
@@ -310,6 +620,9 @@ class FillReader:
     def read(self, datafile):
         return self.bytemeta.from_bytes( datafile.read(len(datafile) - datafile.getpos()) )
 
+    def skip(self, datafile):
+        datafile.seek(len(datafile))
+
     @classmethod
     def getreader(cls, module):
         return cls(module)
@@ -378,9 +691,12 @@ class LoaderModule:
         return self.loader.structure.functions
 
 class Loader:
-    def __init__(self, fmt):
+    def __init__(self, fmt, compiled=True, lazy=False):
         self.formatter = fmt
+        self.compiled = compiled
+        self.lazy = lazy
         self.xrefs = []
+        self.plainrecords = []
         self.simple = { 'uint8': IntReader(1), 'uint16': IntReader(2),
             'uint32': IntReader(4), 'uint64': IntReader(8) }
         self.structure = Structure()
@@ -388,9 +704,15 @@ class Loader:
         self.loadtypes( self.modules[-1] )
 
     def load(self, filename):
+        self.structure.key = (os.path.abspath(filename), self.lazy)
         self.loadfile(filename, True)
         for xref in self.xrefs:
             xref.resolve()
+        if self.lazy:
+            for reader in self.plainrecords:
+                reader.makelazy()
+        if self.compiled:
+            compiler.compilerecords(self.plainrecords, self.structure.functions)
         return self.structure
 
     def loadfile(self, filename, toplevel):
@@ -403,14 +725,17 @@ class Loader:
             module.module = loadpyfile(self.structure, filename)
             if module.module != None:
                 module.module.loadmeta(module)
+            if 'params' in ystr:
+                self.structure.params.update(ystr['params'])
             if 'records' in ystr:
                 self.loadrecords(ystr, module, toplevel)
             if toplevel and 'target' in ystr:
-                self.structure.target = ystr['target']
+                self.structure.target = expression.load(ystr['target'], 'target of ' + filename)
 
     def loadrecords(self, ystr, module, toplevel):
         for yrname, yrec in ystr['records'].items():
             reader = PlainRecordReader.loadreader(yrname, yrec, module)
+            self.plainrecords.append(reader)
             self.structure.records[reader.name] = TypeLoader(reader.getreader, module)
             if toplevel and self.structure.start == None:
                 self.structure.start = reader
@@ -445,9 +770,28 @@ def loadpyfile(structure, filename):
         print(pyfile, 'is not exist, skipped')
         return None
 
-def loadfieldreader(yfield, module):
-    return PlainRecordReader.loadfield(yfield, module)
-
-def loadmeta(filename, fmt):
-    loader = Loader(fmt)
+RECORDS = {}
+
+def restorerecord(key, name, fields):
+    ''' Recreates a pickled record with the reader of the same name from the same structure file '''
+    if (key, name) not in RECORDS:
+        raise Exception(f'Record {name} of structure {key[0] if key else None} is not loaded')
+    reader = RECORDS[(key, name)]
+    data = reader.recordclass(reader)
+    for fname, value in fields.items():
+        setattr(data, fname, value)
+    return data
+
+def makerecordclass(name, fieldnames, lazy=False):
+    ''' Creates a record class with a slot per declared field '''
+    slots = tuple(fieldnames)
+    if not all( map(str.isidentifier, slots) ):
+        slots = ('__dict__',)
+    return type(name.replace('.', '_'), (LazyRecord if lazy else PlainRecord,), { '__slots__': slots })
+
+def loadfieldreader(yfield, module, where='record'):
+    return PlainRecordReader.loadfield(yfield, module, where)
+
+def loadmeta(filename, fmt, compiled=True, lazy=False):
+    loader = Loader(fmt, compiled, lazy)
     return loader.load(filename)
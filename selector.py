@@ -1,22 +1,24 @@
 
+import expression
+
 class Selector:
     def __init__(self):
         self.selector = None
         self.mapping = {}
 
     def select(self, datafile, pos, context):
-        key = eval(self.selector, vars(context))
+        key = self.selector.evaluate(context.getview())
         if key not in self.mapping:
             raise Exception(f'Selector 0x{key:X} not found in the mapping at 0x{pos:X}')
         datafile.seek(pos)
         return self.mapping[key].read(datafile)
 
     @classmethod
-    def load(cls, ymeta, module):
+    def load(cls, ymeta, module, where):
         selector = cls()
-        selector.selector = ymeta['selector']
+        selector.selector = expression.load(ymeta['selector'], where)
         selector.mapping = module.loadtypemapper(ymeta['mapping'])
         return selector
 
-def loadselector(ymeta, module):
-    return Selector.load(ymeta, module)
+def loadselector(ymeta, module, where='selection'):
+    return Selector.load(ymeta, module, where)
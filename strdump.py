@@ -15,10 +15,10 @@ def dump(args):
     print('Filename:', args.filename)
     print('Structures:', args.structures)
     fmt = formatter.getdefault()
-    strdef = records.loadmeta(args.structures, fmt)
+    strdef = records.loadmeta(args.structures, fmt, not args.interpret, args.lazy)
     makeformat(fmt, args, strdef)
     with open(args.filename, 'rb') as datafile:
-        obj = strdef.read(datafile)
+        obj = strdef.read(datafile, args.mapped)
         fmt.apply(obj)
         if len(args.object) > 0:
             print(eval(args.object, obj.getfields()))
@@ -33,5 +33,8 @@ if __name__ == '__main__':
     parser.add_argument('--formatpos', default='', required=False)
     parser.add_argument('--formatsize', default='', required=False)
     parser.add_argument('--formatter', default='', required=False)
+    parser.add_argument('--interpret', action='store_true', help='read records without compiling them')
+    parser.add_argument('--lazy', action='store_true', help='decode record fields on first access')
+    parser.add_argument('--mapped', action='store_true', help='map the file into memory instead of reading it')
     args = parser.parse_args()
     dump(args)
@@ -1,7 +1,17 @@
 import os
+import mmap
+import array
+import operator
+import json
+import hashlib
+import bisect
+import itertools
+import heapq
 import formatter
 import records
 
+BLOCKSIZE = 0x10000
+
 class StreamItem:
     def __init__(self, pos, item):
         self.pos = pos
@@ -56,6 +66,127 @@ class FixedStream:
     def readall(self):
         return self.source
 
+class MappedFile:
+    ''' A file mapped into memory, reads return memoryview slices of the mapping without copying '''
+    def __init__(self, datafile):
+        self.name = getattr(datafile, 'name', None)
+        self.datafile = datafile
+        size = os.fstat(datafile.fileno()).st_size
+        if size > 0:
+            self.mapping = mmap.mmap(datafile.fileno(), 0, access=mmap.ACCESS_READ)
+            self.source = memoryview(self.mapping)
+        else:
+            self.mapping = None
+            self.source = memoryview(bytes())
+        self.pos = 0
+
+    def close(self):
+        ''' Unmaps the file and closes it, while views of the mapping are still in use the mapping
+            stays until the last of them is gone '''
+        self.source.release()
+        if self.mapping is not None:
+            try:
+                self.mapping.close()
+            except BufferError:
+                pass
+            self.mapping = None
+        self.datafile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def seek(self, delta, postype=os.SEEK_SET):
+        if postype == os.SEEK_END:
+            self.pos = len(self.source) + delta
+        elif postype == os.SEEK_CUR:
+            self.pos = self.pos + delta
+        else:
+            self.pos = delta
+        self.pos = max(self.pos, 0)
+        return self.pos
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self.source) - self.pos
+        acc = self.source[self.pos:self.pos+size]
+        self.pos += len(acc)
+        return acc
+
+    def readinto(self, buffer):
+        size = len(self.source[self.pos:self.pos+len(buffer)])
+        buffer[:size] = self.source[self.pos:self.pos+size]
+        self.pos += size
+        return size
+
+    def tell(self):
+        return self.pos
+
+    def getpos(self):
+        return self.pos
+
+    def __len__(self):
+        return len(self.source)
+
+class RunStream:
+    ''' Reads a stream that lies in the given [start, size] runs of a file, the runs are found by whoever
+        knows the structure of the file so that a reader needs nothing else '''
+    def __init__(self, datafile, runs):
+        self.datafile = datafile
+        self.runs = [ tuple(r) for r in runs ]
+        self.firsts = list(itertools.accumulate( map(operator.itemgetter(1), self.runs), initial=0 ))
+        self.views = None
+        self.pos = 0
+
+    def seek(self, delta, postype=os.SEEK_SET):
+        if postype == os.SEEK_END:
+            self.pos = len(self) + delta
+        elif postype == os.SEEK_CUR:
+            self.pos = self.pos + delta
+        else:
+            self.pos = delta
+        self.pos = min( max(self.pos, 0), len(self) )
+        return self.pos
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self) - self.pos
+        size = min(size, len(self) - self.pos)
+        parts = []
+        while size > 0:
+            irun = bisect.bisect_right(self.firsts, self.pos) - 1
+            start, chunk = self.runs[irun]
+            skip = self.pos - self.firsts[irun]
+            chunk = min(size, chunk - skip)
+            self.datafile.seek(start + skip)
+            parts.append(self.datafile.read(chunk))
+            self.pos += chunk
+            size -= chunk
+        if len(parts) == 1:
+            return parts[0]
+        return bytes().join(parts)
+
+    def getrun(self, pos):
+        ''' Returns the run that holds a position as the position where the run starts and a view of the mapping,
+            None unless the file is mapped '''
+        if not isinstance(self.datafile, MappedFile) or not 0 <= pos < len(self):
+            return None
+        if self.views is None:
+            self.views = [ self.datafile.source[start:start+size] for start, size in self.runs ]
+        irun = bisect.bisect_right(self.firsts, pos) - 1
+        return self.firsts[irun], self.views[irun]
+
+    def tell(self):
+        return self.pos
+
+    def getpos(self):
+        return self.pos
+
+    def __len__(self):
+        return self.firsts[-1]
+
 class SubSerialStream(FixedStream):
     def __init__(self, meta, source):
         super().__init__(meta)
@@ -113,6 +244,7 @@ class SubStream:
         self._meta = meta
         self.source = None
         self.offset = 0
+        self.run = None
 
     def seek(self, delta, postype=os.SEEK_SET):
         if postype == os.SEEK_SET:
@@ -123,6 +255,21 @@ class SubStream:
     def read(self, size):
         return self.source.read(size)
 
+    def getrun(self, pos):
+        ''' Returns the run of the source that holds a position as the position where the run starts in this stream
+            and a view of it, None if the source has no runs '''
+        run = self.run
+        if run is None or not run[0] <= pos < run[0] + len(run[1]):
+            run = self.source.getrun(self.offset + pos) if hasattr(self.source, 'getrun') else None
+            if run is None:
+                return None
+            first, view = run
+            if first < self.offset:
+                view = view[self.offset - first:]
+                first = self.offset
+            run = self.run = (first - self.offset, view)
+        return run
+
     def getpos(self):
         ret = self.source.getpos() - self.offset
         if ret < 0:
@@ -136,11 +283,12 @@ class SubStream:
         return size
 
     def reset(self):
+        self.run = None
         self.source.seek(self.offset)
 
     @classmethod
     def make(cls, source, offset):
-        ss = cls()
+        ss = cls(None)
         ss.source = source
         ss.offset = offset
         return ss
@@ -156,6 +304,9 @@ class RecordStream:
         self.record = record
         self.pos = 0
         self.size = self.record.getsize()
+        self.layout = meta.getlayout()
+        self.block = []
+        self.blockstart = 0
 
     def seek(self, delta, postype=os.SEEK_SET):
         if postype == os.SEEK_END:
@@ -168,17 +319,38 @@ class RecordStream:
         return self.pos
 
     def read(self, size):
-        self.source.seek(self.pos * self.size, os.SEEK_SET)
+        if self.layout is None:
+            self.source.seek(self.pos * self.size, os.SEEK_SET)
         mx = len(self.source) // self.size
         acc = []
         while size > 0 and self.pos < mx:
-            instance = self.record.read(self.source)
+            instance = self.readitem()
             self.pos += 1
             size -= 1
             acc.append(instance)
         self.checkpos()
         return acc
 
+    def readitem(self):
+        ''' Reads the record at the current position, records of a static layout are decoded a block at a time '''
+        if self.layout is None:
+            return self.record.read(self.source)
+        iblock = self.pos - self.blockstart
+        if iblock < 0 or iblock >= len(self.block):
+            self.readblock()
+            iblock = self.pos - self.blockstart
+        return self.layout.make(self.block[iblock])
+
+    def readblock(self):
+        count = max(1, BLOCKSIZE // self.size)
+        self.blockstart = self.pos - self.pos % count
+        self.source.seek(self.blockstart * self.size, os.SEEK_SET)
+        raw = self.source.read(count * self.size)
+        if raw.__class__ is list:
+            raw = bytes(raw)
+        count = len(raw) // self.size
+        self.block = list(self.layout.struct.iter_unpack(raw[:count*self.size]))
+
     def checkpos(self):
         mx = len(self.source) // self.size
         if self.pos > mx:
@@ -190,7 +362,8 @@ class RecordStream:
         return self._meta.prettyprint(self)
 
     def reset(self):
-        pass
+        self.block = []
+        self.blockstart = 0
 
     def find(self, condition):
         self.seek(0)
@@ -202,12 +375,41 @@ class RecordStream:
                 return acc[0]
         return None
 
+    def tocolumns(self, fields=None):
+        ''' Returns a column per field, fixed-width integer fields become compact arrays '''
+        if fields is None:
+            fields = getattr(self.record, 'fieldnames', ['value'])
+        columns = makecolumns(self.record, fields)
+        indexes = self.layout.getindexes(fields) if self.layout is not None else None
+        mx = len(self.source) // self.size
+        self.seek(0)
+        if indexes is None:
+            getters = list(map( lambda name: (columns[name].append, getvalue(name, self.record)), fields ))
+            for pos, item in self.selectrange(mx):
+                for append, getter in getters:
+                    append(getter(item))
+            return columns
+        while self.pos < mx:
+            self.readblock()
+            if len(self.block) == 0:
+                break
+            values = list(zip(*self.block))
+            for name, index in indexes.items():
+                columns[name].extend(values[index])
+            self.pos = self.blockstart + len(self.block)
+        self.checkpos()
+        return columns
+
     def selectrange(self, stop, start=0):
         self.seek(start)
+        if self.layout is not None:
+            stop = min(stop, len(self.source) // self.size)
+        else:
+            self.source.seek(self.pos * self.size, os.SEEK_SET)
         while self.pos < stop:
-            if self.source.getpos() >= len(self.source):
+            if self.layout is None and self.source.getpos() >= len(self.source):
                 break
-            item = self.record.read(self.source)
+            item = self.readitem()
             self.pos += 1
             yield self.pos-1, item
 
@@ -216,6 +418,12 @@ class StructuredStreamReader(StreamReader):
     def loadmeta(self, module, yfield):
         self.record = module.getreader(yfield['record'], records.LoaderXRef(self, 'record'))
         self.recformatter = module.loader.formatter.get(yfield['record'])
+        self.layout = None
+
+    def getlayout(self):
+        if self.layout is None:
+            self.layout = records.getlayout(self.record) or False
+        return self.layout or None
 
     def getformatter(self, loader):
         return loader.getformatter('recordstream')
@@ -238,6 +446,7 @@ class SerialStream:
         self.size = None
         self.index = []
         self.step = 16
+        self.types = None
 
     def seek(self, delta, postype=os.SEEK_SET):
         if postype == os.SEEK_END:
@@ -287,9 +496,48 @@ class SerialStream:
             if condition(item):
                 yield self.pos-1, item
 
-    def select(self, condition):
+    def select(self, condition, types=None):
+        ''' Selects records by a condition, with types given only records of these types are decoded and checked '''
+        if types is not None:
+            return SubSerialStream(self._meta, self.selecttypesiter(types, condition))
         return SubSerialStream(self._meta, self.selectiter(condition))
 
+    def selecttypes(self, *types):
+        ''' Selects records by the value of the discriminator field '''
+        return SubSerialStream(self._meta, self.selecttypesiter(types, None))
+
+    def selecttypesiter(self, types, condition):
+        index = self.buildtypes()
+        for pos, offset in heapq.merge( *[ zip(*index[t]) for t in set(types) if t in index ] ):
+            self.source.seek(offset)
+            item = self.record.read(self.source)
+            self.pos = pos + 1
+            if condition is None or condition(item):
+                yield pos, item
+
+    def buildtypes(self):
+        ''' Scans the record headers once and indexes record positions and offsets by the discriminator value '''
+        if self.types is not None:
+            return self.types
+        name = self._meta.discriminator
+        if name is None:
+            raise Exception('Serial stream of ' + str(self.record) + ' has no discriminator')
+        types = {}
+        self.seek(0)
+        while self.source.getpos() != self.sourcesize:
+            offset = self.source.getpos()
+            key = records.skipkey(self.record, self.source, name)
+            if key not in types:
+                types[key] = ( array.array('Q'), array.array('Q') )
+            types[key][0].append(self.pos)
+            types[key][1].append(offset)
+            self.pos += 1
+            if self.pos % self.step == 0 and (self.pos // self.step) >= len(self.index):
+                self.index.append(self.source.getpos())
+        self.size = self.pos
+        self.types = types
+        return types
+
     def selectrange(self, stop, start=0):
         self.seek(start)
         while self.pos < stop:
@@ -306,6 +554,7 @@ class SerialStream:
         self.pos = 0
         self.size = None
         self.index = [0]
+        self.types = None
         self.sourcesize = len(self.source)
 
     def getpos(self):
@@ -326,28 +575,44 @@ class SerialStream:
 
     def syncatpos(self):
         ''' Tries to synchronize either at last chunk observed or at the closest chunk '''
-        pind = min( self.pos // self.step , len(self.index)-1 )
+        if self.pos is None:
+            pind = len(self.index)-1
+        else:
+            pind = min( self.pos // self.step , len(self.index)-1 )
         self.pos = pind * self.step
-        self.source.seek( self.index[self.pos] )
+        self.source.seek( self.index[pind] )
         if self.source.getpos() == self.sourcesize:
-            self.size = self.sourcesize
+            self.size = self.pos
 
 
     def syncroll(self):
         ''' Pre-condition - the position is not the end one and synchronized '''
-        self.record.read(self.source)
+        records.skip(self.record, self.source)
         self.pos += 1
         if self.pos % self.step == 0:
             if (self.pos // self.step) >= len(self.index):
                 self.index.append(self.source.getpos())
         if self.source.getpos() == self.sourcesize:
-            self.size = self.sourcesize
+            self.size = self.pos
 
     def __getitem__(self, key):
         self.seek(key)
         ret = self.read(1)
         return ret[0] if len(ret) > 0 else None
 
+    def count(self):
+        ''' Returns the number of records, the first call skips over all of them to build the index '''
+        if self.size is None:
+            self.buildindex()
+        return self.size
+
+    def buildindex(self):
+        ''' Completes the offset index skipping over the records '''
+        pos = self.pos
+        self.seek(0, os.SEEK_END)
+        self.seek(pos)
+        return self.index
+
     def readall(self):
         self.seek(0)
         all = []
@@ -358,62 +623,118 @@ class SerialStream:
             all.append(r)
         return all
 
+    def saveindex(self, sidecar, key):
+        ''' Completes the offset index and stores it into a sidecar file, the key identifies the source file '''
+        self.buildindex()
+        with open(sidecar, 'w') as idxfile:
+            json.dump( { 'key': key, 'step': self.step, 'sourcesize': self.sourcesize, 'size': self.size,
+                         'index': self.index }, idxfile )
+
+    def loadindex(self, sidecar, key):
+        ''' Restores the offset index from a sidecar file if it was built for the same source '''
+        if not os.path.exists(sidecar):
+            return False
+        with open(sidecar) as idxfile:
+            try:
+                yindex = json.load(idxfile)
+            except ValueError:
+                return False
+        if yindex.get('key') != key or yindex.get('step') != self.step or yindex.get('sourcesize') != self.sourcesize:
+            return False
+        self.index = yindex['index']
+        self.size = yindex['size']
+        self.pos = 0
+        self.source.seek(self.index[0])
+        return True
+
+    def useindex(self, sidecar, key):
+        ''' Loads the offset index from a sidecar file or builds and saves it '''
+        if not self.loadindex(sidecar, key):
+            self.saveindex(sidecar, key)
+
+    def tocolumns(self, fields=None):
+        ''' Returns a column per field of all records, fixed-width integer fields become compact arrays '''
+        if fields is None:
+            if not hasattr(self.record, 'fieldnames'):
+                raise Exception(f'Fields are required to make columns of records read by {type(self.record).__name__}')
+            fields = self.record.fieldnames
+        columns = makecolumns(self.record, fields)
+        getters = list(map( lambda name: (columns[name].append, getvalue(name, self.record)), fields ))
+        self.seek(0)
+        while self.source.getpos() != self.sourcesize:
+            item = self.record.read(self.source)
+            self.pos += 1
+            for append, getter in getters:
+                append(getter(item))
+        return columns
+
 class SerialStreamReader(StructuredStreamReader):
+    def loadmeta(self, module, yfield):
+        super().loadmeta(module, yfield)
+        self.discriminator = yfield.get('discriminator')
+
     def read(self, datafile):
         return SerialStream(self, self.record)
 
 class CombinedStream:
+    ''' A stream that concatenates several streams, offsets holds the start of every source in the combined stream '''
     def __init__(self, meta):
         self._meta = meta
         self.sources = None
         self.sizes = None
+        self.offsets = None
         self.pos = 0
 
     def seek(self, delta, postype=os.SEEK_SET):
         if postype == os.SEEK_END:
-            self.pos = sum(self.sizes)
+            self.pos = self.offsets[-1]
         elif postype == os.SEEK_CUR:
             self.pos = self.pos + delta
         else:
             self.pos = delta
-        self.pos = min (self.pos, sum(self.sizes) )
+        self.pos = min (self.pos, self.offsets[-1] )
         self.pos = max (self.pos, 0)
         return self.pos
 
     def read(self, size):
-        acc = bytes()
+        size = min(size, self.offsets[-1] - self.pos)
+        if size <= 0:
+            return bytes()
         isource, istart = self.mappos()
-        while size >= 0:
+        if istart + size <= self.sizes[isource]:
             self.sources[isource].seek(istart)
-            chunk = self.sizes[isource] - istart
-            acc += self.sources[isource].read( min(size, chunk) )
-            self.pos += min(size, chunk)
-            size -= chunk
+            self.pos += size
+            return self.sources[isource].read(size)
+        acc = []
+        left = size
+        while left > 0 and isource < len(self.sources):
+            chunk = min(left, self.sizes[isource] - istart)
+            self.sources[isource].seek(istart)
+            acc.append(self.sources[isource].read(chunk))
+            left -= chunk
             isource += 1
-            if isource >= len(self.sources):
-                break
             istart = 0
-        return acc
+        self.pos += size - left
+        return bytes().join(acc)
 
     def __repr__(self):
         return self._meta.prettyprint(self)
 
     def mappos(self):
-        istart = self.pos
-        for isource in range(len(self.sources)):
-            if istart < self.sizes[isource]:
-                return isource, istart
-            istart -= self.sizes[isource]
-        return len(self.sources), 0
+        isource = bisect.bisect_right(self.offsets, self.pos) - 1
+        if isource >= len(self.sources):
+            return len(self.sources), 0
+        return isource, self.pos - self.offsets[isource]
 
     def __len__(self):
-        return sum(self.sizes)
+        return self.offsets[-1]
 
     def getpos(self):
         return self.pos
 
     def reset(self):
         self.sizes = list(map( lambda s: s.seek(0, os.SEEK_END), self.sources))
+        self.offsets = [0, *itertools.accumulate(self.sizes)]
 
     @classmethod
     def fromstreams(cls, streams, meta):
@@ -422,6 +743,34 @@ class CombinedStream:
         cs.reset()
         return cs
 
+def filekey(filename):
+    ''' Identifies a file by its path, size, modification time and the hash of its first block,
+        only the first block is read so that the key is cheap for large files '''
+    stat = os.stat(filename)
+    with open(filename, 'rb') as datafile:
+        digest = hashlib.sha256(datafile.read(BLOCKSIZE))
+    return { 'path': os.path.abspath(filename), 'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+             'hash': digest.hexdigest() }
+
+def makecolumns(record, fields):
+    columns = {}
+    for name in fields:
+        typecode = record.getcolumntype(name) if hasattr(record, 'getcolumntype') else None
+        columns[name] = array.array(typecode) if typecode is not None else []
+    return columns
+
+def getvalue(name, record):
+    ''' Returns a getter of a field value, a missing attribute of a dotted path gives None '''
+    if name == 'value' and hasattr(record, 'getformat') and not hasattr(record, 'fieldnames'):
+        return lambda item: item
+    getter = operator.attrgetter(name)
+    def get(item):
+        try:
+            return getter(item)
+        except AttributeError:
+            return None
+    return get
+
 def loadmeta(module):
     module.addtypes( { 'bytestream': ByteStreamReader.getreader, 'recordstream': RecordStreamReader.getreader,
                        'serialstream': SerialStreamReader.getreader, 'substream': SubStreamReader.getreader } )
\ No newline at end of file
@@ -0,0 +1,28 @@
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.append(os.path.join(ROOT, 'ole'))
+
+import xlsgen
+
+EXCEL = os.path.join(ROOT, 'ole', 'excel.struct')
+NSHEETS = 3
+NROWS = 120
+NSTRINGS = 700
+
+@pytest.fixture(scope='session')
+def workbooks(tmp_path_factory):
+    ''' A fragmented and a contiguous workbook with the shared strings they hold '''
+    folder = tmp_path_factory.mktemp('xls')
+    files = {}
+    for name, fragment in (('fragmented', True), ('contiguous', False)):
+        filename = str(folder / (name + '.xls'))
+        files[name] = (filename, xlsgen.write(filename, NSHEETS, NROWS, NSTRINGS, fragment))
+    return files
+
+@pytest.fixture(params=['fragmented', 'contiguous'])
+def workbook(request, workbooks):
+    return workbooks[request.param]
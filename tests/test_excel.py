@@ -0,0 +1,232 @@
+import csv
+import ast
+import math
+import array
+import random
+import pytest
+import records
+import formatter
+import loader
+import streams
+import excel
+import xlsgen
+from conftest import EXCEL, NSHEETS, NROWS
+
+def dump(workbook):
+    ''' Returns the cells of every sheet as (row, column, value, formula) tuples '''
+    sheets = {}
+    for name, sheet in workbook.sheets.items():
+        cells = []
+        for row, column, cell in sheet.itercells():
+            formula = None
+            if cell.formula is not None:
+                formula = [ [ ptg.getfields() for ptg in tokens ] for tokens in cell.formula ]
+            cells.append( (row, column, cell.value, formula) )
+        sheets[name] = cells
+    return sheets
+
+def plain(value):
+    ''' Turns records into dicts and streams into bytes so that records of different readers compare '''
+    if isinstance(value, list):
+        return list( map(plain, value) )
+    if hasattr(value, 'getfields'):
+        return { name: plain(field) for name, field in value.getfields().items() }
+    if hasattr(value, 'raw'):
+        return (value.rectype, bytes(value.raw))
+    if hasattr(value, 'readall'):
+        items = value.readall()
+        return [ plain(item[0] if isinstance(item, list) else item) for item in items ]
+    if hasattr(value, 'seek') and hasattr(value, 'read'):
+        value.seek(0)
+        return bytes(value.read(len(value)))
+    return value
+
+def readnpy(filename):
+    with open(filename, 'rb') as npyfile:
+        data = npyfile.read()
+    size = int.from_bytes(data[8:10], 'little')
+    header = ast.literal_eval(data[10:10+size].decode('latin-1'))
+    return header['shape'], array.array('d', data[10+size:])
+
+def same(a, b):
+    return a == b or (math.isnan(a) and math.isnan(b))
+
+def test_values(workbook):
+    filename, strings = workbook
+    book = loader.load(EXCEL, filename)
+    assert list(book.sheets) == [ 'Sheet%d' % i for i in range(NSHEETS) ]
+    for isheet, sheet in enumerate(book.sheets.values()):
+        assert sheet.getheight() == NROWS
+        values = {}
+        for row, column, cell in sheet.itercells():
+            values.setdefault(row, {})[column] = cell.value
+        for row in range(NROWS):
+            assert values[row] == xlsgen.getvalues(isheet, row, strings)
+
+@pytest.mark.parametrize('options', [ { 'compiled': False }, { 'mapped': True }, { 'lazy': True },
+                                      { 'lazy': True, 'mapped': True }, { 'compiled': False, 'lazy': True } ])
+def test_modes(workbook, options):
+    filename, strings = workbook
+    assert dump(loader.load(EXCEL, filename, **options)) == dump(loader.load(EXCEL, filename))
+
+@pytest.mark.parametrize('mapped', [False, True])
+def test_parallel(workbook, mapped):
+    filename, strings = workbook
+    expected = dump(loader.load(EXCEL, filename))
+    assert dump(excel.loadparallel(EXCEL, filename, 2, mapped)) == expected
+    selected = dump(loader.load(EXCEL, filename, sheets='Sheet1', rows=(3, 17), columns=(1, 4)))
+    assert dump(excel.loadparallel(EXCEL, filename, 2, mapped, sheets='Sheet1', rows=(3, 17), columns=(1, 4))) == selected
+
+def test_selection(workbook):
+    filename, strings = workbook
+    expected = dump(loader.load(EXCEL, filename))
+    book = dump(loader.load(EXCEL, filename, sheets='Sheet1', rows=(3, 17), columns=(1, 4)))
+    assert list(book) == ['Sheet1']
+    assert book['Sheet1'] == [ c for c in expected['Sheet1'] if 3 <= c[0] < 17 and 1 <= c[1] < 4 ]
+
+@pytest.mark.parametrize('mapped', [False, True])
+def test_deferred(workbook, mapped):
+    filename, strings = workbook
+    expected = loader.load(EXCEL, filename)
+    with loader.load(EXCEL, filename, mapped=mapped, deferred=True) as book:
+        assert len(book.sheets['Sheet0']) == 0
+        rows = [ (irow, [ cell.value for cell in row.cells ]) for irow, row in book.iterrows('Sheet0') ]
+        assert rows == [ (irow, [ cell.value for cell in row.cells ]) for irow, row in enumerate(expected.sheets['Sheet0'].rows) ]
+        cells = []
+        for block in book.iterblocks('Sheet2', 7):
+            assert block.getheight() - (block.keys[0] >> 16) <= 7
+            cells.extend( map(lambda c: (c[0], c[1], c[2].value), block.itercells()) )
+        assert cells == [ (r, c, cell.value) for r, c, cell in expected.sheets['Sheet2'].itercells() ]
+    assert book.datafile is None
+
+def test_sparse_sheet():
+    sheet = excel.Sheet('sparse')
+    sheet.setvalue(0, 0, 1)
+    sheet.setvalue(5000, 60000, 'far')
+    assert sheet.getcell(5000, 30000).value is None
+    assert sheet.getcell(5000, 60001) is None
+    assert len(sheet.rows) == 5001
+    assert len(sheet.rows[5000].cells) == 60001
+    assert len(sheet) == 2
+    sheet.rows[5000].cells[7].value = 2.5
+    assert len(sheet) == 3
+    assert sheet.getcell(5000, 7).value == 2.5
+    sheet.getcell(0, 0).value = 4
+    assert [ (r, c, cell.value) for r, c, cell in sheet.itercells() ] == [ (0, 0, 4), (5000, 7, 2.5), (5000, 60000, 'far') ]
+
+def test_export(workbook, tmp_path):
+    filename, strings = workbook
+    sheet = loader.load(EXCEL, filename).sheets['Sheet0']
+    width = max( map(lambda key: key & 0xFFFF, sheet.keys) ) + 1
+    csvname = str(tmp_path / 'sheet.csv')
+    assert excel.exportcsv(sheet, csvname, 16) == NROWS
+    with open(csvname, newline='') as csvfile:
+        rows = list(csv.reader(csvfile))
+    for irow, row in enumerate(rows):
+        cells = [ sheet.getcell(irow, icol) for icol in range(width) ]
+        assert row == [ '' if c is None or c.value is None else str(c.value) for c in cells ]
+    npyname = str(tmp_path / 'sheet.npy')
+    with pytest.raises(Exception, match='holds strings'):
+        excel.exportnpy(sheet, npyname, 16)
+    excel.exportnpy(sheet, npyname, 16, nanstrings=True)
+    shape, data = readnpy(npyname)
+    assert shape == (NROWS, width)
+    for irow in range(NROWS):
+        for icol in range(width):
+            cell = sheet.getcell(irow, icol)
+            value = cell.value if cell is not None else None
+            assert same(data[irow*width+icol], float(value) if value.__class__ in (int, float) else math.nan)
+    with loader.load(EXCEL, filename, deferred=True) as book:
+        blockname = str(tmp_path / 'blocks.npy')
+        excel.exportnpy(book.iterblocks('Sheet0', 10), blockname, 16, columns=(0, width), nanstrings=True)
+    with open(npyname, 'rb') as full, open(blockname, 'rb') as blocks:
+        assert full.read() == blocks.read()
+
+def test_export_sparse(tmp_path):
+    sheet = excel.Sheet('sparse')
+    sheet.setvalue(0, 0, 1)
+    sheet.setvalue(1, 1, 2.5)
+    sheet.setvalue(3, 2, 'x')
+    csvname = str(tmp_path / 'sparse.csv')
+    excel.exportcsv(sheet, csvname, 2)
+    with open(csvname, newline='') as csvfile:
+        assert list(csv.reader(csvfile)) == [ ['1', '', ''], ['', '2.5', ''], ['', '', ''], ['', '', 'x'] ]
+    npyname = str(tmp_path / 'sparse.npy')
+    excel.exportnpy(sheet, npyname, 2, nanstrings=True)
+    shape, data = readnpy(npyname)
+    nan = math.nan
+    assert shape == (4, 3)
+    assert all( map(same, data, [1, nan, nan, nan, 2.5, nan, nan, nan, nan, nan, nan, nan]) )
+
+def test_sidecar_index(workbook, tmp_path):
+    filename, strings = workbook
+    strdef = records.loadmeta(EXCEL, formatter.getminimal())
+    sidecar = str(tmp_path / 'sheet.idx')
+    key = streams.filekey(filename)
+    with open(filename, 'rb') as datafile:
+        bookstream = strdef.read(datafile, deferred=True).workbookloader.sheets[0].bookstream
+        assert not bookstream.loadindex(sidecar, key)
+        bookstream.useindex(sidecar, key)
+        count = bookstream.count()
+        expected = [ (r.rectype, r.size, bytes(r.raw)) for [r] in bookstream.readall() ]
+    assert count == len(expected)
+    with open(filename, 'rb') as datafile:
+        bookstream = strdef.read(datafile, deferred=True).workbookloader.sheets[0].bookstream
+        assert bookstream.loadindex(sidecar, key)
+        assert bookstream.count() == count
+        for pos in random.Random(1).sample(range(count), 50):
+            item = bookstream[pos]
+            assert (item.rectype, item.size, bytes(item.raw)) == expected[pos]
+    assert not bookstream.loadindex(sidecar, dict(key, size=key['size'] + 1))
+
+ORDER = '''namespace: {0}
+version: 1
+records:
+    top:
+        - field: inner
+          type: rec
+    rec:
+        - field: a
+          type: uint8
+        - field: early
+          function: "{1} * 2"
+        - field: b
+          type: uint8
+        - field: after
+          function: "a + b"
+        - field: tail
+          type: uint8
+          count: "a - 1"
+'''
+
+def writestruct(tmp_path, name, early):
+    structure = tmp_path / (name + '.struct')
+    structure.write_text(ORDER.format(name, early))
+    datafile = tmp_path / (name + '.bin')
+    datafile.write_bytes(bytes([3, 5, 7, 9]))
+    return str(structure), str(datafile)
+
+@pytest.mark.parametrize('compiled', [True, False])
+@pytest.mark.parametrize('mapped', [False, True])
+def test_lazy_records(tmp_path, compiled, mapped):
+    structure, datafile = writestruct(tmp_path, 'ordered', 'a')
+    eager = loader.load(structure, datafile, compiled, mapped)
+    lazy = loader.load(structure, datafile, compiled, mapped, lazy=True)
+    assert lazy.inner._lazy is not None
+    assert lazy.inner.getfields() == eager.inner.getfields() == { 'a': 3, 'early': 6, 'b': 5, 'after': 8, 'tail': [7, 9] }
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_lazy_field_order(tmp_path, lazy):
+    structure, datafile = writestruct(tmp_path, 'ahead', 'b')
+    with pytest.raises(NameError):
+        loader.load(structure, datafile, lazy=lazy).inner.early
+
+def test_lazy_excel_records(workbook):
+    filename, strings = workbook
+    results = []
+    for lazy in (False, True):
+        strdef = records.loadmeta(EXCEL, formatter.getminimal(), True, lazy)
+        with open(filename, 'rb') as datafile:
+            wbstream = strdef.read(datafile).wbstream
+            results.append( [ (r.rectype, plain(r.record)) for pos, r in wbstream.selectrange(10**9) ] )
+    assert results[0] == results[1]
@@ -0,0 +1,161 @@
+''' Writes small BIFF8 workbooks inside OLE files for the tests '''
+import struct
+
+SECTSIZE = 512
+FREESECT = 0xFFFFFFFF
+ENDOFCHAIN = 0xFFFFFFFE
+FATSECT = 0xFFFFFFFD
+DIFSECT = 0xFFFFFFFC
+
+def record(rectype, body):
+    return struct.pack('<HH', rectype, len(body)) + body
+
+def rkint(value):
+    return (value << 2) | 2
+
+def rkcents(value):
+    return (int(round(value * 100)) << 2) | 3
+
+def rkdouble(value):
+    return struct.unpack('<I', struct.pack('<d', value)[4:])[0] & 0xFFFFFFFC
+
+def xlstring(text, wide):
+    if wide:
+        return struct.pack('<HB', len(text), 1) + text.encode('utf-16-le')
+    return struct.pack('<HB', len(text), 0) + text.encode('ascii')
+
+def sst(strings):
+    ''' Returns the SST record and its CONTINUE records, strings are split across records '''
+    bodies = []
+    body = bytearray(struct.pack('<II', len(strings), len(strings)))
+    limit = 8224
+    for i, text in enumerate(strings):
+        wide = i % 7 == 3
+        raw = xlstring(text, wide)
+        if len(body) + len(raw) <= limit:
+            body += raw
+            continue
+        charsize = 2 if wide else 1
+        room = limit - len(body)
+        if room < 3 + charsize:
+            bodies.append(bytes(body))
+            body = bytearray(raw)
+            continue
+        split = 3 + (room - 3) // charsize * charsize
+        body += raw[:split]
+        bodies.append(bytes(body))
+        body = bytearray([wide]) + raw[split:]
+    bodies.append(bytes(body))
+    return record(0xFC, bodies[0]) + b''.join( map(lambda b: record(0x3C, b), bodies[1:]) )
+
+def bof():
+    return record(0x809, struct.pack('<HH', 0x600, 0x10) + bytes(12))
+
+def getvalues(isheet, row, strings):
+    ''' Returns the values of the cells of a row as a workbook loader keeps them, by column '''
+    values = { 0: row * 10 + isheet, 1: row + 1, 2: row + 0.25, 3: 1.5 * row, 4: -2.0,
+               5: strings[(row * 3 + isheet) % len(strings)], 8: 1.0 + row }
+    if row % 5 == 0:
+        values[9] = 'str%d' % row
+    return values
+
+def sheet(isheet, nrows, strings):
+    ''' Returns the records of a sheet: RK, MULRK, LABELSST, NUMBER, BLANK, FORMULA and string FORMULA cells '''
+    data = bytearray(bof())
+    data += record(0x200, struct.pack('<IIHHH', 0, nrows, 0, 10, 0))
+    for row in range(nrows):
+        data += record(0x208, struct.pack('<HHHHHHHH', row, 0, 10, 0x0F, 0, 0, 0x100, 0))
+        data += record(0x27E, struct.pack('<HHHI', row, 0, 15, rkint(row * 10 + isheet)))
+        rknums = [ rkint(row + 1), rkcents(row + 0.25), rkdouble(1.5 * row), rkdouble(-2.0) ]
+        data += record(0xBD, struct.pack('<HH', row, 1) + b''.join( map(lambda v: struct.pack('<HI', 15, v), rknums) ) +
+                       struct.pack('<H', 4))
+        data += record(0xFD, struct.pack('<HHHI', row, 5, 15, (row * 3 + isheet) % len(strings)))
+        data += record(0x203, struct.pack('<HHHd', row, 6, 15, row * 0.5))
+        data += record(0x201, struct.pack('<HHH', row, 7, 15))
+        formula = bytes([0x1E]) + struct.pack('<H', 1) + bytes([0x1E]) + struct.pack('<H', row) + bytes([0x03])
+        data += record(0x06, struct.pack('<HHHdHIH', row, 8, 15, 1.0 + row, 0, 0, len(formula)) + formula)
+        if row % 5 == 0:
+            formula = bytes([0x17, 3, 0]) + b'abc'
+            data += record(0x06, struct.pack('<HHH', row, 9, 15) + bytes([0, 0, 0, 0, 0, 0, 0xFF, 0xFF]) +
+                           struct.pack('<HIH', 0, 0, len(formula)) + formula)
+            text = 'str%d' % row
+            data += record(0x207, struct.pack('<HB', len(text), 0) + text.encode('ascii'))
+    data += record(0x0A, b'')
+    return bytes(data)
+
+def workbook(nsheets, nrows, nstrings):
+    ''' Returns the Workbook stream and its shared strings '''
+    strings = [ 'string number %d %s' % (i, 'x' * (i % 50)) for i in range(nstrings) ]
+    data = bytearray(bof())
+    data += record(0x42, struct.pack('<H', 1200))
+    data += record(0x22, struct.pack('<H', 0))
+    bookoffsets = []
+    for isheet in range(nsheets):
+        name = 'Sheet%d' % isheet
+        bookoffsets.append(len(data))
+        data += record(0x85, struct.pack('<IHBB', 0, 0, len(name), 0) + name.encode('ascii'))
+    data += sst(strings)
+    data += record(0x0A, b'')
+    sheets = []
+    pos = len(data)
+    for isheet in range(nsheets):
+        struct.pack_into('<I', data, bookoffsets[isheet] + 4, pos)
+        sheets.append( sheet(isheet, nrows, strings) )
+        pos += len(sheets[-1])
+    return bytes(data) + b''.join(sheets), strings
+
+def ole(stream, name='Workbook', fragment=True):
+    ''' Returns an OLE file of one stream, a fragmented stream has its sectors out of order in places '''
+    stream = stream.ljust(4096, b'\0')
+    nstream = (len(stream) + SECTSIZE - 1) // SECTSIZE
+    ndata = 1 + nstream
+    nfat, ndifat = 1, 0
+    while True:
+        need = (ndata + nfat + ndifat + 127) // 128
+        needdifat = 0 if need <= 109 else (need - 109 + 126) // 127
+        if need == nfat and needdifat == ndifat:
+            break
+        nfat, ndifat = need, needdifat
+    fat = [FREESECT] * (nfat * 128)
+    fat[0] = ENDOFCHAIN
+    order = list(range(1, 1 + nstream))
+    if fragment:
+        for start in range(0, nstream - 8, 80):
+            order[start:start+8] = order[start:start+8][::-1]
+    for sect, nextsect in zip(order, order[1:]):
+        fat[sect] = nextsect
+    fat[order[-1]] = ENDOFCHAIN
+    fatsects = list(range(ndata, ndata + nfat))
+    difatsects = list(range(ndata + nfat, ndata + nfat + ndifat))
+    for sect in fatsects:
+        fat[sect] = FATSECT
+    for sect in difatsects:
+        fat[sect] = DIFSECT
+    header = struct.pack('<Q', 0xE11AB1A1E011CFD0) + bytes(16) + struct.pack('<HHHHH', 0x3E, 3, 0xFFFE, 9, 6) + bytes(6)
+    header += struct.pack('<IIIIIIIII', 0, nfat, 0, 0, 0x1000, ENDOFCHAIN, 0,
+                          difatsects[0] if ndifat else ENDOFCHAIN, ndifat)
+    header += struct.pack('<109I', *(fatsects[:109] + [FREESECT] * (109 - min(109, nfat))))
+    sectors = [None] * (ndata + nfat + ndifat)
+    sectors[0] = direntry('Root Entry', 5, ENDOFCHAIN, 0, 1) + direntry(name, 2, order[0], len(stream)) + bytes(256)
+    for i, sect in enumerate(order):
+        sectors[sect] = stream[i*SECTSIZE:(i+1)*SECTSIZE].ljust(SECTSIZE, b'\0')
+    for i, sect in enumerate(fatsects):
+        sectors[sect] = struct.pack('<128I', *fat[i*128:(i+1)*128])
+    rest = fatsects[109:]
+    for i, sect in enumerate(difatsects):
+        chunk = rest[i*127:(i+1)*127]
+        nextsect = difatsects[i+1] if i + 1 < len(difatsects) else ENDOFCHAIN
+        sectors[sect] = struct.pack('<128I', *(chunk + [FREESECT] * (127 - len(chunk)) + [nextsect]))
+    return header + b''.join(sectors)
+
+def direntry(name, entrytype, start, size, child=FREESECT):
+    raw = name.encode('utf-16-le') + b'\0\0'
+    return raw.ljust(64, b'\0') + struct.pack('<HBBIII', len(raw), entrytype, 1, FREESECT, FREESECT, child) + \
+           bytes(16) + struct.pack('<IQQIII', 0, 0, 0, start, size, 0)
+
+def write(filename, nsheets, nrows, nstrings, fragment=True):
+    ''' Writes a workbook and returns its shared strings '''
+    stream, strings = workbook(nsheets, nrows, nstrings)
+    with open(filename, 'wb') as xlsfile:
+        xlsfile.write(ole(stream, fragment=fragment))
+    return strings
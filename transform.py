@@ -1,6 +1,7 @@
 from collections.abc import Iterable
 import parser
 import records
+import expression
 
 class Transformer:
     def __init__(self):
@@ -12,9 +13,9 @@ class Transformer:
         if self.context == None:
             obj = data
         else:
-            obj = eval(self.context, environ)
+            obj = self.context.evaluate(environ)
         if self.operands != None:
-            for op in eval(self.operands, environ):
+            for op in self.operands.evaluate(environ):
                 self.transformobj(obj, op)
         else:
             self.transformobj(obj, None)
@@ -36,11 +37,7 @@ class TransformerActions:
                 func = getattr(tobj, action)
                 func(op)
             else:
-                if hasattr(tobj, 'getfields'):
-                    context = tobj.getfields()
-                else:
-                    context = vars(tobj)
-                action(context, data=tobj, operands=op)
+                action(expression.getcontext(tobj), data=tobj, operands=op)
 
 class TransformerSetter:
     def __init__(self, field):
@@ -51,7 +48,7 @@ class TransformerSetter:
 
 class TransformLoader:
     @classmethod
-    def loadactions(cls, ymeta, module):
+    def loadactions(cls, ymeta, module, where):
         ''' parsing "do" branch in yaml '''
         trans = TransformerActions()
         if isinstance(ymeta, list):
@@ -59,27 +56,27 @@ class TransformLoader:
                 if isinstance(ydo, str):
                     trans.actions.append(ydo)
                 else:
-                    trans.actions.append( cls.load(ydo, module).transform )
+                    trans.actions.append( cls.load(ydo, module, where).transform )
         else:
             trans.actions.append(ymeta)
         return trans
 
     @classmethod
-    def load (cls, ymeta, module):
+    def load (cls, ymeta, module, where):
         if 'do' in ymeta:
             trans = Transformer()
-            trans.context = ymeta['transform']
+            trans.context = expression.load(ymeta['transform'], where)
             if 'with' in ymeta:
-                trans.operands = ymeta['with']
-            trans.action = cls.loadactions(ymeta['do'], module).perform
+                trans.operands = expression.load(ymeta['with'], where + ', with')
+            trans.action = cls.loadactions(ymeta['do'], module, where).perform
             return trans
         elif 'set' in ymeta:
             trans = Transformer()
-            trans.action = TransformerSetter( records.loadfieldreader(ymeta, module) ).perform
+            trans.action = TransformerSetter( records.loadfieldreader(ymeta, module, where) ).perform
             return trans
         elif 'parse' in ymeta:
-            return parser.loadparser(ymeta, module)
+            return parser.loadparser(ymeta, module, where + ', parse')
         raise Exception('Unknown transformer method at' + str(ymeta))
 
-def loadtransformer(ymeta, module):
-    return TransformLoader.load(ymeta, module)
+def loadtransformer(ymeta, module, where='transform'):
+    return TransformLoader.load(ymeta, module, where)